@@ -12,7 +12,8 @@ from app.models import db
 from app.render import renderer
 from app.settings import DefaultConfig
 from app.cli import pymapnik_cli, postgres_cli, clear_maps,\
-                    create_tables, gen_markers, remove_outdated_maps, render
+                    create_tables, gen_markers, remove_outdated_maps, render,\
+                    render_worker, import_geojson
 
 from uuid import UUID
 from werkzeug.routing import BaseConverter, ValidationError
@@ -50,7 +51,8 @@ def create_app():
     for blueprint in blueprints:
         app.register_blueprint(blueprint)
 
-    cmds = [clear_maps, create_tables, gen_markers, remove_outdated_maps, render]
+    cmds = [clear_maps, create_tables, gen_markers, remove_outdated_maps, render,
+            render_worker, import_geojson]
     for command in [pymapnik_cli, postgres_cli] + cmds:
         app.cli.add_command(command)
 
@@ -1,18 +1,46 @@
-import re
+import os
+import ijson
 
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha256
+from uuid import UUID
 from functools import wraps
 from flask import Blueprint, request, jsonify, abort, redirect,\
-                  url_for, make_response, Response, current_app, render_template
+                  url_for, make_response, Response, current_app, render_template,\
+                  stream_with_context, g
 from flask_cors import CORS
+from sqlalchemy.orm import raiseload
 from werkzeug.security import safe_str_cmp
 from geojson import Feature, FeatureCollection
 from datetime import datetime, timedelta
-from app.models import db, Map, Feature as MapFeature
+from app import tokens, cache, compress
+from app.models import db, Map, Feature as MapFeature, postgis_version
 from app.grid import grid_for_bbox
-from app.utils import datetime_fromisoformat
+from app.importer import import_features
+from app import utils
+from app.utils import datetime_fromisoformat, stream_feature_collection,\
+                      stream_ndjson, feature_topology, rendered_dir,\
+                      write_atomically, normalize_style
 
 api = Blueprint('API', __name__)
-CORS(api)
+CORS(api, expose_headers=['Link', 'X-Next-Cursor', 'ETag'])
+
+
+api.after_request(compress.compress_response)
+
+
+@api.before_app_request
+def reset_map_cache():
+    # maps are cached per request by Map.get (app contexts, and so `g`, may
+    # be shared between requests, e.g. in tests)
+    g.maps = {}
+
+
+def _same_map(a, b):
+    try:
+        return UUID(str(a)) == UUID(str(b))
+    except ValueError:
+        return False
 
 
 def auth():
@@ -22,6 +50,15 @@ def auth():
     if not map_id or not token:
         return False
 
+    # a token only authorizes requests for its own map
+    view_args = request.view_args or {}
+    if 'map_id' in view_args and not _same_map(view_args['map_id'], map_id):
+        return False
+
+    # verified in memory, without loading the map
+    if tokens.is_stateless(token):
+        return tokens.check(token, map_id)
+
     obj = Map.get(map_id)
     if not obj or not obj.check_token(token):
         return False
@@ -40,6 +77,18 @@ def login_required(f):
     return decorated_function
 
 
+def vary_accept(f):
+    """Marks responses (including 304) of views negotiating their format by
+    the Accept header as such for caches"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        response = make_response(f(*args, **kwargs))
+        response.vary.add('Accept')
+        return response
+
+    return decorated_function
+
+
 @api.route('/api/maps/<string:map_id>/auth')
 def gen_auth_token(map_id):
     secret = request.headers.get('X-Secret', '')
@@ -54,10 +103,153 @@ def gen_auth_token(map_id):
     return jsonify(token=obj.gen_token())
 
 
+def _parse_bbox():
+    """Parses the optional `bbox` query argument (minx,miny,maxx,maxy)"""
+    if 'bbox' not in request.args:
+        return None
+    try:
+        bbox = [float(x) for x in request.args['bbox'].split(',')]
+    except ValueError:
+        abort(400)
+    if len(bbox) != 4:
+        abort(400)
+    return bbox
+
+
+def _parse_fields(allowed):
+    """Parses the optional `fields` query argument (sparse fieldsets)"""
+    if 'fields' not in request.args:
+        return None
+    fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+    if not fields or any(f not in allowed for f in fields):
+        abort(400)
+    return fields
+
+
+def _etag(m):
+    """Strong ETag of a map representation: the map version plus a digest of
+    everything else the response depends on (path, query, Accept and content
+    coding)"""
+    variant = '|'.join([request.full_path, request.headers.get('Accept', ''),
+                        compress.negotiate() or ''])
+    return '{}-{}'.format(m.version, sha256(variant.encode()).hexdigest()[:12])
+
+
+def _is_current(etag):
+    """Whether the client already has the current representation"""
+    return request.if_none_match.contains_weak(etag)
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def _with_etag(response, etag):
+    # clients may keep the response but have to revalidate it
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def _check_if_match(m, feature=None):
+    """
+    Optimistic concurrency: if the request has an `If-Match` header (map
+    version or ETag of a map resource) which does not match the current
+    version of the map, abort with `412 Precondition Failed`. The response
+    describes the current state compactly (map data and content hashes of all
+    features and, for feature requests, the current feature) so clients only
+    need to refetch features whose `hash` changed.
+
+    The map row is locked (`SELECT ... FOR UPDATE`) until the end of the
+    transaction, so no concurrent write can change the map between this check
+    and the write of the request.
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return
+
+    db.session.refresh(m, with_for_update=True)
+    if any(tag.split('-')[0] == m.version for tag in if_match):
+        return
+
+    hashes = db.session.query(MapFeature.id, MapFeature._hash) \
+                       .filter(MapFeature.map_uuid == m.uuid) \
+                       .order_by(MapFeature.id)
+    data = {
+        'version': m.version,
+        'map': m.to_dict(False),
+        'features': {id: h for (id, h) in hashes}
+    }
+    if feature is not None:
+        data['feature'] = feature.to_dict()
+    abort(make_response(jsonify(data), 412))
+
+
+def _encode_cursor(m):
+    raw = '{}|{}'.format(m._datetime.isoformat(), m.uuid.hex)
+    return urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        dt, uuid = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return (datetime_fromisoformat(dt), UUID(uuid))
+    except ValueError:
+        abort(400)
+
+
+@api.route('/api/maps/<string:map_id>/secret', methods=['POST'])
+def map_rotate_secret(map_id):
+    """Replaces the secret of a map (requires the current one as
+    `X-Secret`). All previously issued tokens become invalid."""
+    secret = request.headers.get('X-Secret', '')
+    obj = Map.get(map_id)
+
+    if not obj or not secret:
+        abort(400)
+
+    if not safe_str_cmp(secret, obj.secret):
+        abort(401)
+
+    obj.rotate_secret()
+    return jsonify(secret=obj.secret, token=obj.gen_token())
+
+
 @api.route('/api/maps/')
 @api.route('/api/maps')
 def maps():
-    return jsonify([m.to_dict() for m in Map.all()])
+    key = cache.listing_key()
+    cached = cache.get_listing(key)
+    if cached:
+        return cached
+
+    cfg = current_app.config
+    limit = request.args.get('limit', cfg['MAPS_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, cfg['MAPS_PAGE_SIZE_MAX']))
+
+    after = None
+    if 'cursor' in request.args:
+        after = _decode_cursor(request.args['cursor'])
+
+    # fetch one more than requested to know if there is a next page. The
+    # listing never needs features, fail loudly instead of issuing a query
+    # per map
+    fields = _parse_fields([f for f in Map.PUBLIC_FIELDS if f != 'features'])
+    objs = Map.page(limit+1, after, _parse_bbox(), raiseload(Map.features))
+
+    response = jsonify([m.to_dict(fields=fields) for m in objs[:limit]])
+    if len(objs) > limit:
+        cursor = _encode_cursor(objs[limit-1])
+        url = url_for('.maps', cursor=cursor, limit=limit,
+                      bbox=request.args.get('bbox'),
+                      fields=request.args.get('fields'), _external=True)
+        response.headers['Link'] = '<{}>; rel="next"'.format(url)
+        response.headers['X-Next-Cursor'] = cursor
+
+    cache.set_listing(key, response)
+    return response
 
 
 @api.route('/api/maps/', methods=['POST'])
@@ -95,7 +287,12 @@ def map_get(map_id):
     m = Map.get(map_id.hex)
     if not m or not (auth() or m.published) or m.outdated:
         abort(404)
-    return jsonify(m.to_dict())
+
+    fields = _parse_fields(Map.PUBLIC_FIELDS)
+    etag = _etag(m)
+    if _is_current(etag):
+        return _not_modified(etag)
+    return _with_etag(jsonify(m.to_dict(fields=fields)), etag)
 
 
 @api.route('/api/maps/<string:map_id>/', methods=['PATCH'])
@@ -107,6 +304,8 @@ def map_edit(map_id):
     if not m:
         abort(404)
 
+    _check_if_match(m)
+
     json = request.json
 
     for key in ['name', 'bbox', 'description', 'place', 'attributes', 'published']:
@@ -133,19 +332,69 @@ def map_edit(map_id):
 @api.route('/api/maps/<string:map_id>', methods=['DELETE'])
 @login_required
 def map_delete(map_id):
+    m = Map.get(map_id)
+    if not m:
+        abort(404)
+    _check_if_match(m)
     Map.delete(map_id)
     return ('', 204)
 
 
+FEATURE_FORMATS = {
+    'application/json': 'geojson',
+    'application/x-ndjson': 'ndjson',
+    'application/topo+json': 'topojson'
+}
+
+
+def _feature_format():
+    fmt = request.args.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(list(FEATURE_FORMATS))
+        return FEATURE_FORMATS.get(best, 'geojson')
+    if fmt not in FEATURE_FORMATS.values():
+        abort(400)
+    return fmt
+
+
+def _parse_precision():
+    precision = request.args.get('precision', current_app.config['GEOJSON_PRECISION'], type=int)
+    return min(max(precision, 0), 15)
+
+
+def _features_response(m, properties=None):
+    """Streams all features of a map either as FeatureCollection or as
+    newline delimited JSON (one feature per line), or responds with a
+    TopoJSON topology of them"""
+    fmt = _feature_format()
+    if fmt == 'topojson' and not utils.topojson:
+        abort(406)
+
+    batch_size = current_app.config['FEATURES_BATCH_SIZE']
+    features = MapFeature.iter_json(m.uuid, batch_size, _parse_bbox(), _parse_precision())
+    if fmt == 'topojson':
+        return Response(feature_topology(features, properties),
+                        mimetype='application/json')
+    if fmt == 'ndjson':
+        body, mimetype = stream_ndjson(features), 'application/x-ndjson'
+    else:
+        body = stream_feature_collection(features, properties)
+        mimetype = 'application/json'
+    return Response(stream_with_context(body), mimetype=mimetype)
+
+
 @api.route('/api/maps/<string:map_id>/features')
+@vary_accept
 def map_features(map_id):
     m = Map.get(map_id)
 
     if not m or not (m.published or auth()):
         abort(404)
 
-    features = [f.to_dict() for f in m.features]
-    return jsonify(FeatureCollection(features))
+    etag = _etag(m)
+    if _is_current(etag):
+        return _not_modified(etag)
+    return _with_etag(_features_response(m), etag)
 
 
 @api.route('/api/maps/<string:map_id>/features', methods=['POST'])
@@ -171,43 +420,66 @@ def map_features_new(map_id):
            methods=['DELETE'])
 @login_required
 def map_feature_delete(map_id, feature_id):
+    m = Map.get(map_id)
     f = MapFeature.get(feature_id)
-    if not f:
+    if not m or not f or f.map_uuid != m.uuid:
         abort(404)
 
+    _check_if_match(m, f)
+
     db.session.delete(f)
     db.session.commit()
 
     return ('', 200)
 
 
+@api.route('/api/maps/<string:map_id>/features/import', methods=['POST'])
+@login_required
+def map_features_import(map_id):
+    """Imports all features of a (large) GeoJSON FeatureCollection sent as
+    request body. Invalid features are skipped.
+
+    :status 201: features imported
+    """
+    m = Map.get(map_id)
+    if not m:
+        abort(404)
+
+    batch_size = current_app.config['FEATURES_BATCH_SIZE']
+    try:
+        imported, skipped = import_features(m, request.stream, batch_size)
+    except ijson.JSONError:
+        db.session.rollback()
+        abort(400)
+    db.session.commit()
+
+    data = {'imported': imported, 'skipped': skipped, 'version': m.version}
+    return make_response(jsonify(data), 201)
+
+
+def _update_feature(f, data):
+    if 'properties' in data:
+        f.style = normalize_style(data['properties'])
+
+    if 'geometry' in data:
+        f.geo = data['geometry']
+
+
 @api.route('/api/maps/<string:map_id>/features/<int:feature_id>',
            methods=['PUT', 'PATCH'])
 @login_required
 def map_feature_edit(map_id, feature_id):
+    m = Map.get(map_id)
     f = MapFeature.get(feature_id)
-    if not f:
+    if not m or not f or f.map_uuid != m.uuid:
         abort(404)
 
     if not request.json or not Feature(request.json).is_valid:
         abort(400)
 
-    if 'properties' in request.json:
-        props = request.json['properties']
-        if 'iconColor' in props:
-            # ensure that we deal with hex values (not rgb(r,g,b))
-            if props['iconColor'].startswith('rgb'):
-                rgb = re.findall(r'\d+', props['iconColor'])
-                iconColor = ''.join([('%02x' % int(x)) for x in rgb])
-                props['iconColor'] = '#' + iconColor
-
-        if 'weight' in props:
-            props['weight'] = int(props['weight'])
-
-        f.style = props
+    _check_if_match(m, f)
 
-    if 'geometry' in request.json:
-        f.geo = request.json['geometry']
+    _update_feature(f, request.json)
 
     db.session.add(f)
     db.session.commit()
@@ -215,6 +487,112 @@ def map_feature_edit(map_id, feature_id):
     return jsonify(f.to_dict())
 
 
+BATCH_OPERATIONS = ['create', 'update', 'delete']
+
+
+def _check_operation(op, features, seen):
+    """Returns an error (status, message) for an invalid batch operation"""
+    if not isinstance(op, dict) or op.get('op') not in BATCH_OPERATIONS:
+        return (400, 'invalid operation')
+
+    if op['op'] in ['update', 'delete']:
+        if not isinstance(op.get('id'), int) or op['id'] not in features:
+            return (404, 'feature not found')
+        if op['id'] in seen:
+            return (400, 'feature referenced twice')
+        seen.add(op['id'])
+
+    if op['op'] in ['create', 'update']:
+        data = op.get('feature')
+        if not isinstance(data, dict) or not Feature(data).is_valid:
+            return (400, 'invalid feature')
+
+    return None
+
+
+@api.route('/api/maps/<string:map_id>/features/batch', methods=['POST'])
+@login_required
+def map_features_batch(map_id):
+    """Applies mixed create, update and delete operations on features of a
+    map in one transaction. Either all operations succeed or none is applied.
+
+    **Example request**:
+
+    .. sourcecode:: json
+
+      {"operations": [
+        {"op": "create", "feature": {"type": "Feature", "geometry": ...}},
+        {"op": "update", "id": 1, "feature": {"type": "Feature", ...}},
+        {"op": "delete", "id": 2}
+      ]}
+
+    :status 200: all operations applied, `results` holds one entry per
+                 operation
+    :status 400: at least one operation is invalid, nothing was applied
+    """
+    m = Map.get(map_id)
+    if not m:
+        abort(404)
+
+    _check_if_match(m)
+
+    if not isinstance(request.json, dict):
+        abort(400)
+    operations = request.json.get('operations')
+    if not isinstance(operations, list):
+        abort(400)
+
+    # load all referenced features at once (and before any modification, so
+    # everything ends up in a single flush)
+    ids = [op.get('id') for op in operations if isinstance(op, dict)]
+    ids = [i for i in ids if isinstance(i, int)]
+    features = {}
+    if ids:
+        query = db.session.query(MapFeature) \
+                          .filter(MapFeature.map_uuid == m.uuid,
+                                  MapFeature.id.in_(ids))
+        features = {f.id: f for f in query}
+
+    seen = set()
+    errors = [_check_operation(op, features, seen) for op in operations]
+    if any(errors):
+        # 424 (failed dependency) for valid operations which were not applied
+        results = [{'status': e[0], 'error': e[1]} if e else {'status': 424}
+                   for e in errors]
+        return make_response(jsonify(results=results), 400)
+
+    # no operation may trigger a flush of preceding ones (e.g. by a lazy
+    # load), all of them have to end up in a single flush
+    applied = []
+    with db.session.no_autoflush:
+        for op in operations:
+            if op['op'] == 'create':
+                # assigned without loading all features of the map
+                f = MapFeature(op['feature'])
+                f.map = m
+                db.session.add(f)
+                applied.append((201, f))
+            elif op['op'] == 'update':
+                f = features[op['id']]
+                _update_feature(f, op['feature'])
+                applied.append((200, f))
+            else:
+                f = features.pop(op['id'])
+                db.session.delete(f)
+                applied.append((204, f))
+
+    # send one coalesced live event instead of one per feature
+    db.session.info['coalesce'] = m.uuid.hex
+    db.session.add(m)
+    db.session.flush()
+
+    results = [{'status': status, 'feature': f.to_dict()}
+               for (status, f) in applied]
+    db.session.commit()
+
+    return jsonify(version=m.version, results=results)
+
+
 @api.route('/api/grid/<string:bbox>')
 def grid_get(bbox):
     cells = {
@@ -232,13 +610,110 @@ def map_get_grid(map_id):
     m = Map.get(map_id)
     if not m or not (m.published or auth()):
         abort(404)
-    return jsonify(m.grid)
+
+    etag = _etag(m)
+    if _is_current(etag):
+        return _not_modified(etag)
+    return _with_etag(jsonify(m.grid), etag)
+
+
+@api.route('/api/maps/<string:map_id>/tiles/<int:z>/<int:x>/<int:y>.mvt')
+def map_tile(map_id, z, x, y):
+    """Mapbox Vector Tile of the features of a map"""
+    m = Map.get(map_id)
+    if not m or not (m.published or auth()):
+        abort(404)
+
+    if z > current_app.config['TILE_MAX_ZOOM'] or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+
+    # ST_TileEnvelope is available since PostGIS 3.0
+    if postgis_version() < (3, 0):
+        abort(404)
+
+    etag = _etag(m)
+    if _is_current(etag):
+        return _not_modified(etag)
+
+    tile = cache.get_tile(m, z, x, y)
+    if tile is None:
+        tile = MapFeature.mvt_tile(m.uuid, z, x, y)
+        cache.set_tile(m, z, x, y, tile)
+    response = Response(tile, mimetype='application/vnd.mapbox-vector-tile')
+    return _with_etag(response, etag)
+
+
+# export formats by extension: mimetype and binary encoding (GeoJSON is
+# streamed by the application, binary formats are encoded by PostgreSQL)
+EXPORT_FORMATS = {
+    'geojson': ('application/json', None),
+    'fgb': ('application/flatgeobuf', 'flatgeobuf'),
+    'pbf': ('application/geobuf', 'geobuf')
+}
+
+# minimum PostGIS version of binary encodings
+EXPORT_POSTGIS_VERSIONS = {
+    'flatgeobuf': (3, 2),
+    'geobuf': (2, 4)
+}
+
+
+def _export_extension(extension):
+    if extension is not None:
+        if extension not in EXPORT_FORMATS:
+            abort(404)
+        return extension
+
+    mimetypes = {mimetype: ext for (ext, (mimetype, _)) in EXPORT_FORMATS.items()}
+    return mimetypes.get(request.accept_mimetypes.best_match(list(mimetypes)), 'geojson')
+
+
+def _export_file(m, extension='geojson'):
+    """Path of the export of the current version of a map (written, GeoJSON
+    with compressed sidecars, if it does not exist yet)"""
+    filename = os.path.join(rendered_dir(m.uuid.hex), m.version + '.' + extension)
+    if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        _, fmt = EXPORT_FORMATS[extension]
+        if fmt:
+            write_atomically(filename, [MapFeature.export_binary(m.uuid, fmt)])
+        else:
+            batch_size = current_app.config['FEATURES_BATCH_SIZE']
+            precision = current_app.config['GEOJSON_PRECISION']
+            features = MapFeature.iter_json(m.uuid, batch_size, precision=precision)
+            write_atomically(filename, stream_feature_collection(features, m.to_dict(False)))
+            compress.write_sidecars(filename)
+    return filename
 
 
 @api.route('/api/maps/<string:map_id>/geojson')
-def map_export_geojson(map_id):
+@api.route('/api/maps/<string:map_id>/export.<string:extension>')
+@vary_accept
+def map_export_geojson(map_id, extension=None):
     m = Map.get(map_id)
     if not m or not (m.published or auth()):
         abort(404)
-    features = [f.to_dict() for f in m.features]
-    return jsonify(FeatureCollection(features, properties=m.to_dict(False)))
+
+    extension = _export_extension(extension)
+    mimetype, fmt = EXPORT_FORMATS[extension]
+    if fmt and postgis_version() < EXPORT_POSTGIS_VERSIONS[fmt]:
+        abort(406)
+
+    etag = _etag(m)
+    if _is_current(etag):
+        return _not_modified(etag)
+
+    if fmt:
+        filename = _export_file(m, extension)
+        name = '{}.{}'.format(m.uuid.hex, extension)
+        response = compress.send_precompressed(filename, mimetype, as_attachment=True,
+                                               attachment_filename=name)
+        return _with_etag(response, etag)
+
+    # the complete export is written (and compressed) once per version for
+    # clients accepting compression, everything else is streamed
+    if compress.negotiate() and not request.args and _feature_format() == 'geojson':
+        response = compress.send_precompressed(_export_file(m), mimetype)
+        return _with_etag(response, etag)
+
+    return _with_etag(_features_response(m, m.to_dict(False)), etag)
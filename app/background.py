@@ -0,0 +1,191 @@
+"""
+Background rasters of maps rendered by the tileserver (`MAP_RENDERER`).
+
+A background only depends on theme, bbox and size of a map, not on its
+features. Rasters are therefore cached on disk, content addressed by the
+tileserver url, and shared between all renderings (every feature edit
+triggers a new rendering). The cache is trimmed to `BACKGROUND_CACHE_SIZE`
+bytes, least recently used first (the access time of a file is its last use,
+the modification time when it was fetched).
+
+Backgrounds older than `BACKGROUND_MAX_AGE` are served stale while they are
+fetched again in a background thread. All requests to the tileserver go
+through one pooled session per process and a circuit breaker (shared by all
+workers through redis), so renderings fail fast instead of waiting for an
+unhealthy tileserver.
+"""
+import os
+import time
+import threading
+import requests
+
+from hashlib import sha256
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from app.utils import write_atomically
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+BREAKER_OPEN_KEY = 'tileserver:open'
+BREAKER_FAILURES_KEY = 'tileserver:failures'
+
+_session = None
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+
+def session():
+    """HTTP session (with connection pool) shared by all renderings of this
+    process"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.mount('http://', HTTPAdapter(pool_maxsize=4, max_retries=1))
+        _session.mount('https://', HTTPAdapter(pool_maxsize=4, max_retries=1))
+    return _session
+
+
+def url_for_background(theme, bbox, width, height):
+    renderer_url = current_app.config['MAP_RENDERER'][theme]
+    return renderer_url.format(','.join(str(x) for x in bbox), width, height)
+
+
+def cache_dir():
+    return current_app.config['BACKGROUND_CACHE_DIR'] or \
+        os.path.join(current_app.instance_path, 'backgrounds')
+
+
+def cached_filename(url):
+    return os.path.join(cache_dir(), sha256(url.encode()).hexdigest() + '.png')
+
+
+def _redis():
+    return current_app.task_queue.connection
+
+
+def is_available():
+    """Whether the circuit breaker lets requests to the tileserver through"""
+    return not _redis().exists(BREAKER_OPEN_KEY)
+
+
+def _record_success():
+    _redis().delete(BREAKER_FAILURES_KEY)
+
+
+def _record_failure():
+    """Opens the circuit after BREAKER_THRESHOLD consecutive failures for
+    BREAKER_RESET_TIMEOUT seconds. Afterwards a single failure opens it
+    again (half open) until a request succeeds."""
+    threshold = current_app.config['BREAKER_THRESHOLD']
+    reset_timeout = current_app.config['BREAKER_RESET_TIMEOUT']
+
+    connection = _redis()
+    failures = connection.incr(BREAKER_FAILURES_KEY)
+    connection.expire(BREAKER_FAILURES_KEY, 2 * reset_timeout)
+    if failures >= threshold:
+        connection.set(BREAKER_OPEN_KEY, 1, ex=reset_timeout)
+        connection.set(BREAKER_FAILURES_KEY, threshold - 1, ex=2 * reset_timeout)
+
+
+def fetch(url):
+    """Downloads a background (PNG) or returns None if the tileserver fails
+    (or is known to be unhealthy)"""
+    if not is_available():
+        return None
+
+    try:
+        response = session().get(url, timeout=current_app.config['BACKGROUND_TIMEOUT'])
+    except requests.RequestException:
+        current_app.logger.warning('Fetching background %s failed', url, exc_info=True)
+        _record_failure()
+        return None
+
+    if response.status_code != 200:
+        current_app.logger.warning('Fetching background %s failed with %s', url,
+                                   response.status_code)
+        # client errors (e.g. an unknown style) say nothing about its health
+        if response.status_code >= 500:
+            _record_failure()
+        return None
+
+    _record_success()
+
+    # e.g. error pages of proxies in between are not cached as background
+    if not response.content.startswith(PNG_SIGNATURE):
+        current_app.logger.warning('Background %s is not a PNG', url)
+        return None
+    return response.content
+
+
+def _store(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    write_atomically(filename, [data])
+    trim(os.path.dirname(filename), current_app.config['BACKGROUND_CACHE_SIZE'])
+
+
+def _revalidate(app, url, filename):
+    with app.app_context():
+        try:
+            data = fetch(url)
+            if data:
+                _store(filename, data)
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(url)
+
+
+def revalidate(url, filename):
+    """Fetches a background again in a background thread (once at a time)"""
+    with _revalidating_lock:
+        if url in _revalidating:
+            return None
+        _revalidating.add(url)
+
+    app = current_app._get_current_object()
+    thread = threading.Thread(target=_revalidate, args=(app, url, filename),
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def trim(directory, max_size):
+    """Removes least recently used files until all files of directory fit
+    into max_size bytes"""
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith('.png'):
+            stat = entry.stat()
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+
+    size = sum(entry_size for (_, entry_size, _) in entries)
+    for (_, entry_size, filename) in sorted(entries):
+        if size <= max_size:
+            break
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        size -= entry_size
+
+
+def get(theme, bbox, width, height):
+    """PNG data of a background, from cache if possible (stale ones are
+    revalidated in the background). None if the tileserver fails."""
+    url = url_for_background(theme, bbox, width, height)
+    filename = cached_filename(url)
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        # set access time explicitly (it's often not updated on read)
+        fetched_at = os.stat(filename).st_mtime
+        os.utime(filename, (time.time(), fetched_at))
+    except FileNotFoundError:
+        data = None
+
+    if data is None:
+        data = fetch(url)
+        if data:
+            _store(filename, data)
+    elif time.time() - fetched_at > current_app.config['BACKGROUND_MAX_AGE']:
+        revalidate(url, filename)
+    return data
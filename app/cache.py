@@ -0,0 +1,134 @@
+"""
+Shared (redis) caches of the public map listing and of vector tiles.
+
+Cached listings are stored under a generation number. Any change of a
+published map (or of a map being unpublished) or of its features increments
+the generation (through the model signals), which invalidates all cached
+pages at once. Entries expire at the latest when the next published map
+expires.
+
+Vector tiles are cached under the version of their map and therefore never
+need to be invalidated, outdated tiles simply expire.
+"""
+import json
+
+from uuid import UUID
+from hashlib import sha256
+from flask import current_app, request, Response, has_app_context
+from sqlalchemy import func
+from app.models import db, Map, Feature
+
+GENERATION_KEY = 'maps-listing:generation'
+LISTING_KEY = 'maps-listing:{}:{}'
+TILE_KEY = 'map-tile:{}:{}:{}/{}/{}'
+
+
+def _redis():
+    return current_app.task_queue.connection
+
+
+def listing_key():
+    """Cache key of the current listing request (None if the cache is
+    disabled). Determine it before querying, so a listing is never stored
+    under a generation newer than its data."""
+    if not current_app.config['LISTING_CACHE_TTL']:
+        return None
+    generation = int(_redis().get(GENERATION_KEY) or 0)
+    digest = sha256(request.url.encode()).hexdigest()
+    return LISTING_KEY.format(generation, digest)
+
+
+def _ttl():
+    """Seconds until the cache has to expire (at the latest when the next
+    published map expires)"""
+    ttl = current_app.config['LISTING_CACHE_TTL']
+    next_expiry = db.session.query(func.min(Map.expires_at)) \
+                            .filter(Map.published.is_(True),
+                                    Map._bbox.isnot(None),
+                                    Map.expires_at > func.now()) \
+                            .scalar()
+    if next_expiry:
+        now = db.session.query(func.now()).scalar()
+        ttl = min(ttl, int((next_expiry - now).total_seconds()))
+    return max(ttl, 1)
+
+
+def get_listing(key):
+    """Cached response of the current listing request or None"""
+    if not key:
+        return None
+
+    cached = _redis().get(key)
+    if not cached:
+        return None
+
+    data = json.loads(cached)
+    return Response(data['body'], headers=data['headers'],
+                    mimetype='application/json')
+
+
+def set_listing(key, response):
+    if not key:
+        return
+
+    headers = {k: v for (k, v) in response.headers.items()
+               if k in ['Link', 'X-Next-Cursor']}
+    data = {'body': response.get_data(as_text=True), 'headers': headers}
+    _redis().set(key, json.dumps(data), ex=_ttl())
+
+
+def get_tile(m, z, x, y):
+    """Cached vector tile of the current version of a map or None"""
+    if not current_app.config['TILE_CACHE_TTL']:
+        return None
+    return _redis().get(TILE_KEY.format(m.uuid.hex, m.version, z, x, y))
+
+
+def set_tile(m, z, x, y, tile):
+    ttl = current_app.config['TILE_CACHE_TTL']
+    if ttl:
+        _redis().set(TILE_KEY.format(m.uuid.hex, m.version, z, x, y), tile, ex=ttl)
+
+
+def _enabled():
+    return has_app_context() and current_app.config['LISTING_CACHE_TTL']
+
+
+def invalidate_listing():
+    if _enabled():
+        _redis().incr(GENERATION_KEY)
+
+
+@Map.on_created.connect
+@Map.on_updated.connect
+@Map.on_deleted.connect
+@Feature.on_created.connect
+@Feature.on_updated.connect
+@Feature.on_deleted.connect
+@Feature.on_batch.connect
+def on_changed(data):
+    if _enabled() and _is_listed(data):
+        invalidate_listing()
+
+
+def _is_listed(data):
+    """Whether the map affected by a model signal is or was part of the
+    listing (only published maps are listed)"""
+    if 'new' not in data:
+        # features of a batch
+        return _is_published(data['map_id'])
+
+    if 'map_id' not in data['new'].get('properties', {}):
+        # map
+        return data['new'].get('published') or data['old'].get('published')
+
+    # features are part of the listing through the map version
+    return _is_published(data['new']['properties']['map_id'])
+
+
+def _is_published(map_id):
+    published = db.session.query(Map.published) \
+                          .filter(Map.uuid == UUID(map_id)) \
+                          .scalar()
+    # unknown (e.g. just deleted) maps have their own signal
+    return bool(published)
@@ -1,5 +1,6 @@
 import click
 import sh
+import time
 
 from flask import current_app
 from flask.cli import with_appcontext
@@ -13,7 +14,12 @@ from path import Path
 from app.tasks import render_map
 from os import makedirs
 from urllib.request import urlopen
-from app.surface import SurfaceRenderer
+from app.surface import SurfaceRenderer, preload
+from app.importer import import_features
+from app.utils import remove_orphaned_rendered
+from app.cache import invalidate_listing
+from sqlalchemy.orm import joinedload
+from rq import SimpleWorker
 
 
 @click.command(help="clear map directory")
@@ -29,13 +35,23 @@ def create_tables():
     db.create_all()
 
 
-@click.command(help="remove outdated maps from DB")
+@click.command(help="remove outdated maps (and their renderings) from DB")
+@click.option('--batch-size', default=100, show_default=True)
 @with_appcontext
-def remove_outdated_maps():
-    outdated_maps = db.session.query(Map).filter_by(outdated=True).all()
-    for m in outdated_maps:
-        db.session.delete(m)
-    db.session.commit()
+def remove_outdated_maps(batch_size):
+    started = time.time()
+    count = 0
+    for uuids in Map.purge_outdated(batch_size):
+        count += len(uuids)
+    click.echo("Removed {} outdated maps".format(count))
+
+    # purging bypasses the model signals
+    if count:
+        invalidate_listing()
+
+    uuids = (uuid.hex for (uuid,) in db.session.query(Map.uuid).yield_per(1000))
+    orphaned = remove_orphaned_rendered(uuids, started)
+    click.echo("Removed {} orphaned rendering directories".format(orphaned))
 
 
 @click.command(help="generate markers")
@@ -71,10 +87,41 @@ def gen_markers():
 @click.command(help="Render a given map")
 @click.option('--mid')
 @click.option('--filename')
+@click.option('--no-background', is_flag=True, help="Render features only")
 @with_appcontext
-def render(mid, filename):
-    m = Map.get(mid)
+def render(mid, filename, no_background):
+    m = Map.get(mid, joinedload(Map.features))
     data = m.to_dict(grid_included=True, features_included=True)
-    renderer = SurfaceRenderer(data)
+    renderer = SurfaceRenderer(data, background=not no_background)
     with open(filename, 'wb') as f2:
         f2.write(renderer.render('application/pdf').read())
+
+
+@click.command(help="Run a render worker which keeps the app, styles, fonts "
+                    "and markers loaded between jobs")
+@click.option('--burst', is_flag=True, help="Quit once the queue is empty")
+@with_appcontext
+def render_worker(burst):
+    # jobs run in this process (no fork per job) within its app context, so
+    # everything preloaded here is shared by all renderings
+    preload()
+    queue = current_app.task_queue
+    SimpleWorker([queue], connection=queue.connection).work(burst=burst)
+
+
+@click.command(help="Import features of a GeoJSON FeatureCollection into a map")
+@click.argument('mid')
+@click.argument('geojson', type=click.File('rb'))
+@click.option('--batch-size', default=5000, show_default=True)
+@with_appcontext
+def import_geojson(mid, geojson, batch_size):
+    m = Map.get(mid)
+    if not m:
+        raise click.BadParameter('map not found', param_hint='mid')
+
+    def progress(imported, skipped):
+        click.echo("\r{} imported, {} skipped".format(imported, skipped), nl=False)
+
+    imported, skipped = import_features(m, geojson, batch_size, progress)
+    db.session.commit()
+    click.echo("\nImported {} features into {}".format(imported, m.uuid.hex))
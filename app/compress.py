@@ -0,0 +1,110 @@
+"""
+Content negotiated compression (gzip and, if available, brotli).
+
+JSON responses of the API are compressed on the fly (incrementally for
+streamed responses). Immutable, versioned files (renderings, exports) get
+compressed sidecars (`<file>.gz`, `<file>.br`) written once, which are served
+directly.
+"""
+import gzip
+import zlib
+
+from os import path
+from flask import request, send_file
+from app.utils import write_atomically
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ['application/json', 'application/x-ndjson', 'image/svg+xml',
+                'application/vnd.mapbox-vector-tile']
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# smaller responses are not worth compressing
+MIN_SIZE = 1024
+
+
+def encodings():
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def negotiate():
+    """Preferred content coding of the client which we support (or None)"""
+    return request.accept_encodings.best_match(encodings())
+
+
+def compress(data, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, 9 if best else 6)
+
+
+def compress_stream(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # wbits=31: deflate with gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(response):
+    """after_request hook compressing (JSON) responses"""
+    if response.status_code != 200 or response.direct_passthrough or\
+       'Content-Encoding' in response.headers or\
+       response.mimetype not in COMPRESSIBLE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def sidecar(filename, encoding):
+    return filename + SUFFIXES[encoding]
+
+
+def write_sidecars(filename):
+    """Writes compressed copies of a file for all supported encodings"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for encoding in encodings():
+        write_atomically(sidecar(filename, encoding), [compress(data, encoding, True)])
+
+
+def send_precompressed(filename, mimetype, **kwargs):
+    """Sends a file, or its compressed sidecar if the client accepts it"""
+    encoding = negotiate() if mimetype in COMPRESSIBLE else None
+    if encoding and path.exists(sidecar(filename, encoding)):
+        response = send_file(sidecar(filename, encoding), mimetype=mimetype,
+                             conditional=True, **kwargs)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_file(filename, mimetype=mimetype, conditional=True,
+                             **kwargs)
+
+    if mimetype in COMPRESSIBLE:
+        response.vary.add('Accept-Encoding')
+    return response
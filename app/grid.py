@@ -122,17 +122,16 @@ def grid_for_bbox(x_min, y_min, x_max, y_max, cells_x, cells_y, style_family=GRI
 
 import mapnik
 import math
-from app.utils import get_size, nearest_n
-from pyproj import Transformer
+from app.utils import get_size, nearest_n, wgs_to_merc
 
 def scalebar_for_bbox(lng_min, lat_min, lng_max, lat_max, cells=5):
     south_east = mapnik.Coord(lng_min, lat_min)
     north_west = mapnik.Coord(lng_max, lat_max)
 
     # bbox in mercator
-    wgs_to_merc = Transformer.from_crs(4326, 3857, always_xy=True)
-    south_east_merc = mapnik.Coord(*wgs_to_merc.transform(lng_min, lat_min))
-    north_west_merc = mapnik.Coord(*wgs_to_merc.transform(lng_max, lat_max))
+    transformer = wgs_to_merc()
+    south_east_merc = mapnik.Coord(*transformer.transform(lng_min, lat_min))
+    north_west_merc = mapnik.Coord(*transformer.transform(lng_max, lat_max))
     bbox_merc = mapnik.Box2d(south_east_merc, north_west_merc)
 
     # calculate distance of scalebar
@@ -148,7 +147,7 @@ def scalebar_for_bbox(lng_min, lat_min, lng_max, lat_max, cells=5):
     offset_y = bbox_merc.height() / 30
     offset = mapnik.Coord(offset_x, offset_y)
     end_merc = north_west_merc - offset
-    end = mapnik.Coord(*wgs_to_merc.transform(end_merc.x, end_merc.y, direction='INVERSE'))
+    end = mapnik.Coord(*transformer.transform(end_merc.x, end_merc.y, direction='INVERSE'))
 
     # calculate start as end-distance_in_m
     # see https://stackoverflow.com/questions/7477003/calculating-new-longitude-latitude-from-old-n-meters
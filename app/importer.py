@@ -0,0 +1,98 @@
+import csv
+import json
+import ijson
+
+from io import StringIO
+from shapely.errors import ShapelyError
+from shapely.geometry import shape, mapping
+from app.models import db, Feature
+from app.utils import normalize_style
+
+
+COPY_FEATURES = "COPY feature (map_uuid, _geo, style, _hash) " \
+                "FROM STDIN WITH (FORMAT csv)"
+
+
+def iter_features(f):
+    """Stream-parses the features of a GeoJSON FeatureCollection"""
+    return ijson.items(f, 'features.item', use_float=True)
+
+
+def normalize(feature):
+    """Returns (geometry, properties) of a feature or None if it is invalid.
+    Invalid (self-intersecting) polygons are repaired and styles normalized
+    as for features created through the API."""
+    if not isinstance(feature, dict) or feature.get('type') != 'Feature':
+        return None
+
+    try:
+        geom = shape(feature['geometry'])
+        if not geom.is_valid and geom.geom_type in ['Polygon', 'MultiPolygon']:
+            geom = geom.buffer(0)
+    except (KeyError, TypeError, ValueError, AttributeError, ShapelyError):
+        return None
+
+    if geom.is_empty or not geom.is_valid:
+        return None
+
+    properties = feature.get('properties')
+    if properties is not None:
+        if not isinstance(properties, dict):
+            return None
+        try:
+            normalize_style(properties)
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    return (geom, properties)
+
+
+def _copy(cursor, rows):
+    buf = StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cursor.copy_expert(COPY_FEATURES, buf)
+
+
+def import_features(m, f, batch_size=5000, progress=None):
+    """
+    Imports all features of a GeoJSON FeatureCollection (file object) into a
+    map. Features are validated and normalized in batches and loaded with
+    COPY in the current transaction. `progress` is called with the number of
+    imported and skipped features after each batch.
+
+    The caller has to commit.
+    """
+    cursor = db.session.connection().connection.cursor()
+    imported = skipped = 0
+    rows = []
+
+    def flush():
+        _copy(cursor, rows)
+        rows.clear()
+        if progress:
+            progress(imported, skipped)
+
+    for feature in iter_features(f):
+        normalized = normalize(feature)
+        if not normalized:
+            skipped += 1
+            continue
+
+        geom, properties = normalized
+        style = json.dumps(properties) if properties is not None else None
+        content_hash = Feature.content_hash(mapping(geom), properties)
+        rows.append((m.uuid.hex, geom.wkb_hex, style, content_hash))
+        imported += 1
+
+        if len(rows) >= batch_size:
+            flush()
+
+    if rows:
+        flush()
+
+    # COPY bypasses the ORM, so the map's version has to be updated manually
+    m._version = m.compute_version()
+    db.session.add(m)
+
+    return (imported, skipped)
@@ -45,3 +45,8 @@ def feature_on_updated(data):
 def feature_on_deleted(data):
     room = data['new']['properties']['map_id']
     socketio.emit('feature-deleted', data['new'], room=room)
+
+
+@Feature.on_batch.connect
+def features_on_batch(data):
+    socketio.emit('features-batch', data, room=data['map_id'])
@@ -1,4 +1,5 @@
 import os
+import re
 import flask_sqlalchemy
 import geojson
 import json
@@ -7,48 +8,96 @@ import string
 import pytz
 import random
 
-from uuid import uuid4
+from uuid import uuid4, UUID as PyUUID
+from functools import lru_cache
 from hashlib import sha256
 from geoalchemy2.shape import from_shape, to_shape
-from sqlalchemy import desc, inspect, text, func
+from sqlalchemy import desc, inspect, text, func, tuple_, not_, cast,\
+                       literal_column
 from sqlalchemy.sql import func
 from sqlalchemy.sql.functions import concat
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.dialects.postgresql import JSONB, UUID, INTERVAL
+from sqlalchemy.dialects.postgresql import JSON, JSONB, UUID, INTERVAL
 from shapely.geometry import shape, mapping, box
 from itsdangerous import TimedJSONWebSignatureSerializer, BadSignature,\
                          SignatureExpired
 from geoalchemy2 import Geometry
 from blinker import Namespace
 from sqlalchemy import event
-from flask import url_for
+from sqlalchemy.orm.attributes import set_committed_value
+from flask import url_for, g, has_request_context
+from app import tokens
 from app.grid import grid_for_bbox
-from app.utils import orientation_for_bbox
+from app.utils import orientation_for_bbox, remove_rendered
 
 
 db = flask_sqlalchemy.SQLAlchemy()
 db_signals = Namespace()
 
+DEFAULT_LIFESPAN = pydatetime.timedelta(days=30)
+
 
 def _gen_secret(length=24):
     chars = string.ascii_letters + string.digits
     return ''.join(random.SystemRandom().choice(chars) for _ in range(length))
 
 
+@lru_cache(maxsize=1024)
+def _serializer(secret):
+    return TimedJSONWebSignatureSerializer(secret, expires_in=60*60*2)
+
+
+def _hash(data):
+    raw = json.dumps(data, separators=(',', ':'), sort_keys=True)
+    return sha256(raw.encode()).hexdigest()
+
+
+_postgis_version = None
+
+
+def postgis_version():
+    """Version of the PostGIS library as tuple of ints (queried once per
+    process)"""
+    global _postgis_version
+    if _postgis_version is None:
+        version = db.session.query(func.postgis_lib_version()).scalar()
+        _postgis_version = tuple(int(n) for n in re.findall(r'\d+', version)[:3])
+    return _postgis_version
+
+
 class Map(db.Model):
     uuid = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
     secret = db.Column(db.Unicode, default=_gen_secret)
+    secret_generation = db.Column(db.Integer, default=0, server_default='0',
+                                  nullable=False)
     name = db.Column(db.Unicode)
     description = db.Column(db.Unicode)
     place = db.Column(db.Unicode)
     _datetime = db.Column(db.DateTime(timezone=True), default=func.now())
-    _bbox = db.Column(Geometry('POLYGON'))
-    features = db.relationship('Feature', backref='map', lazy=True, order_by="Feature.id", cascade="all, delete-orphan")
+    _bbox = db.Column(Geometry('POLYGON', spatial_index=True))
+    features = db.relationship('Feature', backref='map', lazy=True, order_by="Feature.id", cascade="all, delete-orphan", passive_deletes=True)
     attributes = db.Column(JSONB)
     published = db.Column(db.Boolean, default=False)
-    lifespan = db.Column(db.Interval, default=pydatetime.timedelta(days=30))
+    lifespan = db.Column(db.Interval, default=DEFAULT_LIFESPAN)
     theme = db.Column(db.Unicode, default='bright')
+    _version = db.Column(db.Unicode)
+
+    DEFAULT_FIELDS = ['id', 'name', 'description', 'datetime', 'attributes',
+                      'bbox', 'place', 'lifespan', 'published', 'theme']
+    # fields clients can select (`?fields=`)
+    PUBLIC_FIELDS = DEFAULT_FIELDS + ['version', 'grid', 'features']
+
+    # materialized _datetime + lifespan (maintained on flush), so that
+    # filtering outdated maps can use an index
+    expires_at = db.Column(db.DateTime(timezone=True))
+
+    __table_args__ = (
+        db.Index('ix_map_published_datetime_uuid', '_datetime', 'uuid',
+                 postgresql_where=db.and_(published.is_(True),
+                                          _bbox.isnot(None))),
+        db.Index('ix_map_expires_at', 'expires_at'),
+    )
 
     on_created = db_signals.signal('map-created')
     on_updated = db_signals.signal('map-updated')
@@ -62,26 +111,53 @@ class Map(db.Model):
 
     @property
     def serializer(self):
-        if not hasattr(self, '_serializer'):
-            self._serializer = TimedJSONWebSignatureSerializer(self.secret,
-                                                               expires_in=60*60*2)
-        return self._serializer
+        return _serializer(self.secret)
 
     @classmethod
-    def all(cls):
-        return db.session.query(Map).filter(Map._bbox.isnot(None),
+    def published_query(cls, *options):
+        return db.session.query(Map).options(*options) \
+                                    .filter(Map._bbox.isnot(None),
                                             Map.published.is_(True), \
-                                            Map.outdated.is_(False)) \
-                                    .order_by(desc(Map._datetime))    \
-                                    .all()
+                                            not_(Map.outdated))
+
+    @classmethod
+    def all(cls, *options):
+        return cls.published_query(*options) \
+                  .order_by(desc(Map._datetime), desc(Map.uuid)) \
+                  .all()
+
+    @classmethod
+    def page(cls, limit, after=None, bbox=None, *options):
+        """Keyset pagination over published maps (newest first). `after` is
+        the `(datetime, uuid)` pair of the last map of the previous page.
+        If a `bbox` is given, only maps intersecting it are returned."""
+        query = cls.published_query(*options)
+        if bbox:
+            query = query.filter(func.ST_Intersects(Map._bbox, func.ST_MakeEnvelope(*bbox)))
+        if after:
+            query = query.filter(tuple_(Map._datetime, Map.uuid) < tuple_(*after))
+        return query.order_by(desc(Map._datetime), desc(Map.uuid)) \
+                    .limit(limit) \
+                    .all()
 
     @classmethod
-    def get(cls, uuid):
+    def get(cls, uuid, *options):
+        """Returns the map with the given id. Within a request every map is
+        looked up at most once (cached in `flask.g`, keyed by UUID)."""
         try:
-            return db.session.query(Map).filter(Map.uuid == uuid).first()
-        except:
-            pass
-        return None
+            uuid = uuid if isinstance(uuid, PyUUID) else PyUUID(str(uuid))
+        except ValueError:
+            return None
+
+        cache = g.setdefault('maps', {}) if has_request_context() else {}
+        if uuid not in cache:
+            try:
+                cache[uuid] = db.session.query(Map).options(*options) \
+                                                   .filter(Map.uuid == uuid) \
+                                                   .first()
+            except:
+                return None
+        return cache[uuid]
 
     @classmethod
     def find(cls, name):
@@ -93,8 +169,37 @@ class Map(db.Model):
 
     @classmethod
     def delete(cls, uuid):
-        db.session.delete(cls.get(uuid))
+        # features are deleted by the database (ON DELETE CASCADE)
+        m = cls.get(uuid)
+        map_uuid = m.uuid
+        db.session.delete(m)
         db.session.commit()
+        if has_request_context():
+            g.get('maps', {}).pop(map_uuid, None)
+        remove_rendered(map_uuid.hex)
+        tokens.forget([map_uuid.hex])
+
+    @classmethod
+    def purge_outdated(cls, batch_size=100):
+        """Deletes outdated maps in chunks of `batch_size`, each chunk in its
+        own transaction, and yields the ids of the deleted maps per chunk.
+        Rows locked by others are skipped, so concurrent runs are safe."""
+        while True:
+            outdated = db.select([Map.uuid]).where(Map.outdated) \
+                                             .limit(batch_size) \
+                                             .with_for_update(skip_locked=True)
+            stmt = Map.__table__.delete().where(Map.uuid.in_(outdated)) \
+                                         .returning(Map.uuid)
+            uuids = [uuid.hex for (uuid,) in db.session.execute(stmt)]
+            db.session.commit()
+
+            if not uuids:
+                break
+
+            for uuid in uuids:
+                remove_rendered(uuid)
+            tokens.forget(uuids)
+            yield uuids
 
     @hybrid_property
     def outdated(self):
@@ -103,7 +208,12 @@ class Map(db.Model):
 
     @outdated.expression
     def outdated(cls):
-        return cls._datetime < (func.now()-cls.lifespan)
+        return cls.expires_at < func.now()
+
+    def update_expires_at(self):
+        start = self._datetime if self._datetime is not None else func.now()
+        lifespan = self.lifespan if self.lifespan is not None else DEFAULT_LIFESPAN
+        self.expires_at = start + lifespan
 
     @property
     def orientation(self):
@@ -124,9 +234,19 @@ class Map(db.Model):
 
     @property
     def version(self):
-        data = self.to_dict(False, features_included=True)
-        raw = json.dumps(data, separators=(',', ':'), sort_keys=True)
-        return sha256(raw.encode()).hexdigest()
+        return self._version
+
+    def compute_version(self):
+        """Root hash over the map's own data and the stored content hashes
+        of its features (ordered by id). Features are not loaded, only their
+        ids and hashes are queried."""
+        hashes = db.session.query(Feature.id, Feature._hash) \
+                           .filter(Feature.map_uuid == self.uuid) \
+                           .order_by(Feature.id)
+        return _hash({
+            'map': self.to_dict(False),
+            'features': [[id, h] for (id, h) in hashes]
+        })
 
     @hybrid_property
     def datetime(self):
@@ -171,38 +291,46 @@ class Map(db.Model):
         if (value is not None):
             self._bbox = from_shape(box(*value))
 
-    def to_dict(self, version_included=True, secret_included=False, grid_included=False, features_included=False):
-        data = {
-            'id': self.uuid.hex,
-            'name': self.name,
-            'description': self.description,
-            'datetime': self.datetime.isoformat(),
-            'attributes': self.attributes if self.attributes else [],
-            'bbox': self.bbox,
-            'place': self.place,
-            'lifespan': self.lifespan.days,
-            'published': self.published,
-            'theme': self.theme
+    def to_dict(self, version_included=True, secret_included=False, grid_included=False, features_included=False, fields=None):
+        """Serializes the map. If `fields` is given, only these fields are
+        included (and computed), otherwise the default fields plus the
+        optional ones requested by the flags."""
+        if fields is None:
+            fields = list(Map.DEFAULT_FIELDS)
+            flags = [('version', version_included), ('secret', secret_included),
+                     ('grid', grid_included), ('features', features_included)]
+            fields += [field for (field, included) in flags if included]
+
+        getters = {
+            'id': lambda: self.uuid.hex,
+            'name': lambda: self.name,
+            'description': lambda: self.description,
+            'datetime': lambda: self.datetime.isoformat(),
+            'attributes': lambda: self.attributes if self.attributes else [],
+            'bbox': lambda: self.bbox,
+            'place': lambda: self.place,
+            'lifespan': lambda: self.lifespan.days,
+            'published': lambda: self.published,
+            'theme': lambda: self.theme,
+            'version': lambda: self.version,
+            'secret': lambda: self.secret,
+            'grid': lambda: self.grid,
+            'features': lambda: [f.to_dict() for f in self.features]
         }
 
-        if version_included:
-            data['version'] = self.version
-
-        if secret_included:
-            data['secret'] = self.secret
-
-        if grid_included:
-            data['grid'] = self.grid
-
-        if features_included:
-            data['features'] = [f.to_dict() for f in self.features]
-
-        return data
+        return {field: getters[field]() for field in fields}
 
     def gen_token(self):
-        return self.serializer.dumps(self.uuid.hex).decode('utf-8')
+        if not tokens.keys():
+            # no server key configured, sign with the secret of the map
+            return self.serializer.dumps(self.uuid.hex).decode('utf-8')
+        return tokens.dumps(self.uuid.hex, self.secret_generation or 0)
 
     def check_token(self, token):
+        if tokens.is_stateless(token):
+            return tokens.check(token, self.uuid.hex)
+
+        # tokens signed with the map secret (issued by former versions)
         try:
             self.serializer.loads(token)
         except SignatureExpired:
@@ -212,6 +340,14 @@ class Map(db.Model):
 
         return True
 
+    def rotate_secret(self):
+        """Generates a new secret, which revokes all issued tokens"""
+        self.secret = _gen_secret()
+        self.secret_generation = (self.secret_generation or 0) + 1
+        db.session.add(self)
+        db.session.commit()
+        tokens.revoke(self.uuid.hex, self.secret_generation)
+
     def publish(self):
         self.published = True
         db.session.add(self)
@@ -220,13 +356,15 @@ class Map(db.Model):
 
 class Feature(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    map_uuid = db.Column(UUID(as_uuid=True), db.ForeignKey('map.uuid'), nullable=False)
-    _geo = db.Column(Geometry())
+    map_uuid = db.Column(UUID(as_uuid=True), db.ForeignKey('map.uuid', ondelete='CASCADE'), nullable=False, index=True)
+    _geo = db.Column(Geometry(spatial_index=True))
     style = db.Column(JSONB)
+    _hash = db.Column(db.Unicode)
 
     on_created = db_signals.signal('feature-created')
     on_updated = db_signals.signal('feature-updated')
     on_deleted = db_signals.signal('feature-deleted')
+    on_batch = db_signals.signal('features-batch')
 
     def __init__(self, feature):
         if 'geometry' in feature:
@@ -250,21 +388,109 @@ class Feature(db.Model):
 
         self._geo = from_shape(shape(value))
 
+    @staticmethod
+    def content_hash(geometry, style):
+        return _hash({'geometry': geometry, 'properties': style})
+
+    @classmethod
+    def json_expression(cls, precision=15):
+        """SQL expression building the same GeoJSON Feature as `to_dict` in
+        PostgreSQL (coordinates rounded to `precision` decimal places)"""
+        properties = func.coalesce(cls.style, literal_column("'{}'::jsonb")) \
+                         .op('||')(func.jsonb_build_object(
+                             'id', cls.id,
+                             'map_id', func.replace(cast(cls.map_uuid, db.Unicode), '-', '')))
+        return func.json_build_object(
+            'type', 'Feature',
+            'geometry', cast(func.ST_AsGeoJSON(cls._geo, precision), JSON),
+            'properties', properties,
+            'hash', cls._hash)
+
+    @classmethod
+    def iter_json(cls, map_uuid, batch_size=500, bbox=None, precision=15):
+        """Yields all features of a map (optionally only those intersecting
+        `bbox`) serialized as GeoJSON by PostgreSQL. Rows are fetched in
+        batches from a server-side cursor."""
+        query = db.session.query(cast(cls.json_expression(precision), db.Unicode)) \
+                          .filter(cls.map_uuid == map_uuid)
+        if bbox:
+            query = query.filter(func.ST_Intersects(cls._geo, func.ST_MakeEnvelope(*bbox)))
+        query = query.order_by(cls.id).yield_per(batch_size)
+        for (feature,) in query:
+            yield feature
+
+    @classmethod
+    def mvt_tile(cls, map_uuid, z, x, y, extent=4096, buffer=64):
+        """Mapbox Vector Tile (one layer `features`) with all features of a map
+        intersecting tile z/x/y encoded by PostgreSQL (requires PostGIS >=
+        3.0)"""
+        envelope = func.ST_TileEnvelope(z, x, y)
+        # geometries are stored in WGS84 but without SRID
+        geometry = func.ST_Transform(func.ST_SetSRID(cls._geo, 4326), 3857)
+        bounds = func.ST_SetSRID(func.ST_Transform(envelope, 4326), 0)
+        rows = db.session.query(func.ST_AsMVTGeom(geometry, envelope, extent, buffer).label('geom'),
+                                cls.id.label('id'),
+                                cls.style.label('style')) \
+                         .filter(cls.map_uuid == map_uuid,
+                                 func.ST_Intersects(cls._geo, bounds)) \
+                         .subquery('tile_rows')
+        tile = db.session.query(func.ST_AsMVT(literal_column('tile_rows'), 'features',
+                                              extent, 'geom', 'id')) \
+                         .select_from(rows) \
+                         .scalar()
+        return bytes(tile or b'')
+
+    @classmethod
+    def export_binary(cls, map_uuid, fmt):
+        """All features of a map encoded by PostgreSQL either as FlatGeobuf
+        (with packed R-tree, requires PostGIS >= 3.2) or as Geobuf"""
+        rows = db.session.query(func.ST_SetSRID(cls._geo, 4326).label('geom'),
+                                cls.id.label('id'),
+                                cast(cls.style, db.Unicode).label('style')) \
+                         .filter(cls.map_uuid == map_uuid) \
+                         .subquery('export_rows')
+        if fmt == 'flatgeobuf':
+            encoded = func.ST_AsFlatGeobuf(literal_column('export_rows'), True, 'geom')
+        elif fmt == 'geobuf':
+            encoded = func.ST_AsGeobuf(literal_column('export_rows'), 'geom')
+        else:
+            raise ValueError('Unknown format {}'.format(fmt))
+        data = db.session.query(encoded).select_from(rows).scalar()
+        return bytes(data or b'')
+
     def to_dict(self):
         properties = self.style.copy() if self.style else {}
 
         properties['id'] = self.id
-        properties['map_id'] = self.map.uuid.hex
+        properties['map_id'] = self.map_uuid.hex
 
-        return geojson.Feature(geometry=self.geo, properties=properties)
+        # content hash (as in the version of the map), lets clients detect
+        # changed features
+        return geojson.Feature(geometry=self.geo, properties=properties,
+                               hash=self._hash)
 
 
 @event.listens_for(db.session, 'after_commit')
 def receive_after_commit(session):
+    # feature changes of a batch are sent as one event for the whole map
+    coalesce = session.info.pop('coalesce', None)
+    batch = {'map_id': coalesce}
+
     for action in ['created', 'updated', 'deleted']:
         if action in session.info:
             for (cls, data) in session.info[action]:
-                getattr(cls, 'on_' + action).send(data)
+                if coalesce and cls is Feature:
+                    batch.setdefault(action, []).append(data['new'])
+                else:
+                    getattr(cls, 'on_' + action).send(data)
+
+    if coalesce:
+        Feature.on_batch.send(batch)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def receive_after_rollback(session):
+    session.info.pop('coalesce', None)
 
 
 @event.listens_for(db.session, 'before_flush')
@@ -276,6 +502,36 @@ def receive_before_flush(session, flush_context, instances):
                                 if action == 'deleted' or
                                 session.is_modified(obj, False)]
 
+    # collect maps whose version needs to be recomputed after the flush and
+    # rehash only the features which actually changed
+    versioned = set()
+    for action in ['created', 'updated', 'deleted']:
+        for obj in session.info[action]:
+            if isinstance(obj, Map):
+                if action != 'deleted':
+                    obj.update_expires_at()
+                versioned.add(obj)
+            elif isinstance(obj, Feature):
+                if action != 'deleted':
+                    obj._hash = Feature.content_hash(obj.geo, obj.style)
+                if obj.map is not None:
+                    versioned.add(obj.map)
+    _lock_maps(session, versioned)
+    session.info['versioned'] = versioned
+
+
+def _lock_maps(session, maps):
+    """Locks the rows of (already stored) maps until the end of the
+    transaction. Concurrent transactions changing the same map wait, so each
+    computes the version from the features committed by the other one."""
+    uuids = sorted(m.uuid for m in maps if inspect(m).has_identity)
+    if uuids:
+        # ordered by uuid, so transactions locking several maps don't deadlock
+        session.query(Map.uuid).filter(Map.uuid.in_(uuids)) \
+                               .order_by(Map.uuid) \
+                               .with_for_update() \
+                               .all()
+
 
 def _get_history(obj):
     hist = {}
@@ -287,8 +543,21 @@ def _get_history(obj):
                 pass
     return hist
 
+def _update_versions(session):
+    for m in session.info.pop('versioned', []):
+        if m in session.deleted or inspect(m).deleted:
+            continue
+        version = m.compute_version()
+        if version != m._version:
+            table = Map.__table__
+            session.execute(table.update().where(table.c.uuid == m.uuid)
+                                          .values(_version=version))
+            set_committed_value(m, '_version', version)
+
+
 @event.listens_for(db.session, 'after_flush')
 def receive_after_flush(session, flush_context):
+    _update_versions(session)
     for action in ['created', 'updated', 'deleted']:
         if action in session.info:
             session.info[action] = [(obj.__class__, {
@@ -15,8 +15,10 @@ renderer = Blueprint('Renderer', __name__)
 CORS(renderer)
 
 from app.tasks import get_file_info, file_exists
-from app.utils import InvalidUsage, UnsupportedFileType
+from app.utils import InvalidUsage, UnsupportedFileType, degraded_marker,\
+                      is_degraded
 from app.models import Map
+from app.compress import send_precompressed
 
 @renderer.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
@@ -73,7 +75,13 @@ def map_download(map_id, file_type, version=None):
 
     # map is already rendered
     if os.path.exists(path):
-        return send_file(path, attachment_filename=filename, mimetype=mimetype)
+        response = send_precompressed(path, mimetype,
+                                      attachment_filename=filename)
+        # content behind a versioned url never changes (unless it was
+        # rendered without background)
+        if request.view_args.get('version') and not os.path.exists(degraded_marker(path)):
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
 
     # map is not yet rendered
     return map_render(map_id, file_type)
@@ -94,6 +102,7 @@ def status_by_job(job):
                                   job.meta['file_type'])
         data['url'] = url_for('static', filename=file_info['path'],
                               _external=True)
+        data['degraded'] = is_degraded(file_info)
 
     # if request is from a user (no client api user)., then display waiting page
     if request.headers.get('Accept') != 'application/json':
@@ -110,6 +119,19 @@ def _find_in_registry(registry, map_id, version, file_type):
            job.meta['file_type'] == file_type:
             return job
 
+
+def _pending_job(map_id, version, file_type):
+    """Queued or currently rendering job of a map"""
+    queue = current_app.task_queue
+    for job in queue.get_jobs():
+        if job.meta['map_id'] == map_id and\
+           job.meta['version'] == version and\
+           job.meta['file_type'] == file_type:
+            return job
+
+    started = StartedJobRegistry(queue=queue)
+    return _find_in_registry(started, map_id, version, file_type)
+
 # TODO:
 #   * Add support for status without version (read version from LATEST symlink)
 @renderer.route('/api/maps/<string:map_id>.<string:file_type>/status')
@@ -127,17 +149,8 @@ def status_by_map(map_id, file_type, version):
     :status 404: map and or version of map not found
     """
 
-    # check if it is queued to be rendered
-    queue = current_app.task_queue
-    for job in queue.get_jobs():
-        if job.meta['map_id'] == map_id and\
-           job.meta['version'] == version and\
-           job.meta['file_type'] == file_type:
-            return status_by_job(job)
-
-    # check if it is currently rendering
-    started = StartedJobRegistry(queue=queue)
-    job = _find_in_registry(started, map_id, version, file_type)
+    # check if it is queued to be rendered or currently rendering
+    job = _pending_job(map_id, version, file_type)
     if job:
         return status_by_job(job)
 
@@ -147,7 +160,7 @@ def status_by_map(map_id, file_type, version):
         abort(404)
 
     # enhance output with job_id if it is recently rendered
-    finished = FinishedJobRegistry(queue=queue)
+    finished = FinishedJobRegistry(queue=current_app.task_queue)
     job = _find_in_registry(finished, map_id, version, file_type)
     if job:
         return status_by_job(job)
@@ -157,7 +170,8 @@ def status_by_map(map_id, file_type, version):
         'file_type': file_type,
         'version': version,
         'status': 'finished',
-        'url': url_for('static', filename=file_info['path'], _external=True)
+        'url': url_for('static', filename=file_info['path'], _external=True),
+        'degraded': is_degraded(file_info)
     }
     return jsonify(**data)
 
@@ -202,11 +216,17 @@ def map_render(map_id, file_type):
     # if already rendered or enqueued, don't enqueue again
     version = _map.version
     force = request.args.get('force', default=False, type=bool)
-    try:
-        if not force:
+    if not force and is_degraded(get_file_info(map_id, version, file_type)):
+        # rendered without background (tileserver was unavailable), render
+        # again unless that already happens
+        job = _pending_job(map_id, version, file_type)
+        if job:
+            return status_by_job(job)
+    elif not force:
+        try:
             return status_by_map(map_id, file_type, version)
-    except NotFound:
-        pass
+        except NotFound:
+            pass
 
     data = _map.to_dict(grid_included=True, features_included=True)
     args = (data, file_type, force)
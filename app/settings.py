@@ -24,11 +24,63 @@ class DefaultConfig(object):
 
     REDIS_HOST = 'localhost'
 
+    # edit tokens are valid for two hours. Tokens are revoked by rotating the
+    # secret of a map, which other processes notice after at most
+    # TOKEN_REVOCATION_TTL seconds
+    TOKEN_EXPIRES_IN = 60*60*2
+    TOKEN_REVOCATION_TTL = 10
+
+    # (key id, key) pairs for signing edit tokens. The first key signs new
+    # tokens, all of them are accepted (add new keys in front to rotate)
+    @property
+    def TOKEN_KEYS(self):
+        return [('1', self.SECRET_KEY)]
+
     TILESERVER_HOST = 'localhost:8080'
 
     # needed for events
     SQLALCHEMY_TRACK_MODIFICATIONS = True
 
+    # page size of the published map listing (?limit= is capped by max)
+    MAPS_PAGE_SIZE = 100
+    MAPS_PAGE_SIZE_MAX = 500
+
+    # max seconds the public map listing is cached in redis (0 disables it)
+    LISTING_CACHE_TTL = 300
+
+    # number of features fetched per round trip when streaming features
+    FEATURES_BATCH_SIZE = 500
+
+    # decimal places of coordinates in feature output unless requested
+    # otherwise with `?precision=` (7 places are about 1cm)
+    GEOJSON_PRECISION = 7
+
+    # highest zoom level vector tiles are served for and seconds they are
+    # cached in redis (0 disables the cache)
+    TILE_MAX_ZOOM = 22
+    TILE_CACHE_TTL = 3600
+
+    # backgrounds fetched from the tileserver are cached on disk (defaults to
+    # <instance path>/backgrounds) up to the given size in bytes and fetched
+    # again (while serving the cached one) after max age seconds. Requests
+    # time out after (connect, read) seconds
+    BACKGROUND_CACHE_DIR = None
+    BACKGROUND_CACHE_SIZE = 512 * 1024 * 1024
+    BACKGROUND_MAX_AGE = 60*60*24*7
+    BACKGROUND_TIMEOUT = (3.05, 30)
+
+    # the tileserver is skipped for reset timeout seconds after threshold
+    # consecutive failures (maps are rendered without background meanwhile)
+    BREAKER_THRESHOLD = 3
+    BREAKER_RESET_TIMEOUT = 30
+
+    # source of map backgrounds: 'renderer' (static images of MAP_RENDERER) or
+    # 'tiles' (composed of MAP_TILES, cached in one MBTiles file per theme in
+    # TILES_CACHE_DIR, defaults to <instance path>/tiles)
+    BACKGROUND_SOURCE = 'renderer'
+    TILES_CACHE_DIR = None
+    TILES_MAX_ZOOM = 18
+
     DEJAVU_FONT_PATH = '/usr/share/fonts/TTF/DejaVuSansCondensed.ttf'
 
     # url encoded <bbox>,<width>,<height>
@@ -43,6 +95,16 @@ class DefaultConfig(object):
             #'maptiler-toner': 'http://localhost:8080/styles/maptiler-toner/static/{}/{}x{}.png'
         }
 
+    # <z>, <x>, <y>
+    @property
+    def MAP_TILES(self):
+        base_url = 'http://{}/styles/'.format(self.TILESERVER_HOST)
+        return {
+            'basic': base_url + 'basic-preview/{}/{}/{}.png',
+            'bright': base_url + 'osm-bright/{}/{}/{}.png',
+            'positron': base_url + 'positron/{}/{}/{}.png'
+        }
+
     @property
     def SQLALCHEMY_DATABASE_URI(self):
         return 'postgresql://{}:{}@{}/{}'.format(self.DB_USER, self.DB_PASS,
@@ -76,6 +138,19 @@ class ProductionConfig(DefaultConfig):
     def TILESERVER_HOST(self):
         return get_env_variable("TILESERVER_HOST")
 
+    # comma separated <key id>:<key> pairs, e.g. "2:new-key,1:old-key". If
+    # unset, maps sign edit tokens with their own secret
+    @property
+    def TOKEN_KEYS(self):
+        pairs = [pair.strip() for pair in os.environ.get('TOKEN_KEYS', '').split(',')]
+        return [tuple(pair.split(':', 1)) for pair in pairs if ':' in pair]
+
 class TestingConfig(ProductionConfig):
     TESTING = True
 
+    TOKEN_KEYS = [('test', 'token key of the test suite')]
+
+    # tests reset the database behind the back of the cache
+    LISTING_CACHE_TTL = 0
+    TILE_CACHE_TTL = 0
+
@@ -5,31 +5,103 @@ import json
 import math
 import geojson
 import shutil
-import requests
 import math
 import shapely
 import pathlib
 import numpy
+import os
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
 from flask import current_app
-from pyproj import Transformer
+from app import background, tiles
 from app.models import Map
-from app.utils import strip, nearest_n, get_size
+from app.utils import strip, nearest_n, get_size, wgs_to_merc
+
+STYLES_DIR = str(pathlib.Path(__file__).parent / '..' / 'styles')
+
+_executor = None
+
+
+@lru_cache()
+def _style(filename):
+    """Content of a mapnik style (read once per process)"""
+    with open(os.path.join(STYLES_DIR, filename)) as f:
+        return f.read()
+
+
+def preload():
+    """Loads everything renderings of this process share up front: styles,
+    fonts and (by rendering all of them once) marker images, which mapnik
+    keeps in its marker cache"""
+    for filename in ['grid.xml', 'features.xml', 'overlay.xml']:
+        _style(filename)
+
+    font_dir = os.path.dirname(current_app.config['DEJAVU_FONT_PATH'])
+    if os.path.isdir(font_dir):
+        mapnik.register_fonts(font_dir)
+
+    bbox = [13.4, 52.5, 13.5, 52.55]
+    features = []
+    markers_dir = os.path.join(STYLES_DIR, 'markers')
+    if os.path.isdir(markers_dir):
+        for color in sorted(os.listdir(markers_dir)):
+            for name in sorted(os.listdir(os.path.join(markers_dir, color))):
+                properties = {'iconColor': color, 'icon': os.path.splitext(name)[0]}
+                features.append(geojson.Feature(geometry=geojson.Point(bbox[:2]),
+                                                properties=properties))
+
+    from app.grid import grid_for_bbox
+    obj = {
+        'id': None,
+        'bbox': bbox,
+        'theme': None,
+        'grid': grid_for_bbox(*bbox, 7, 7, 'violet'),
+        'features': features
+    }
+    SurfaceRenderer(obj, background=False).render()
+
+
+def _fetch_background(app, theme, bbox, width, height):
+    """Background of a map as cairo surface (or None if unavailable) and the
+    seconds it took"""
+    start = time.perf_counter()
+    surface = None
+    with app.app_context():
+        try:
+            if app.config['BACKGROUND_SOURCE'] == 'tiles':
+                data = tiles.compose(theme, bbox, width, height)
+            else:
+                data = background.get(theme, bbox, width, height)
+            if data:
+                surface = cairo.ImageSurface.create_from_png(BytesIO(data))
+        except Exception:
+            # e.g. undecodable images, redis or cache (disk, sqlite) errors:
+            # the map is rendered without background (degraded)
+            app.logger.warning('Fetching background failed', exc_info=True)
+    return surface, time.perf_counter() - start
 
 
-class SurfaceRenderer:
-    def __init__(self, obj):
-        # bbox in mercator
-        proj = mapnik.Projection('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs +over')
+def _submit(*args):
+    # created lazily, so forked rq work horses don't inherit the pool
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=4)
+    return _executor.submit(*args)
 
-        # use pyproj as mapnik is built without proj4 support
-        wgs_to_merc = Transformer.from_crs(4326, 3857, always_xy=True)
 
+class SurfaceRenderer:
+    def __init__(self, obj, background=True):
+        start = time.perf_counter()
+
+        # bbox in mercator
         bbox_wgs84 = mapnik.Box2d(*obj['bbox'])
 
-        south_west_merc = wgs_to_merc.transform(bbox_wgs84.minx, bbox_wgs84.miny)
-        north_east_merc = wgs_to_merc.transform(bbox_wgs84.maxx, bbox_wgs84.maxy)
+        transformer = wgs_to_merc()
+        south_west_merc = transformer.transform(bbox_wgs84.minx, bbox_wgs84.miny)
+        north_east_merc = transformer.transform(bbox_wgs84.maxx, bbox_wgs84.maxy)
         bbox_merc = mapnik.Box2d(*south_west_merc, *north_east_merc)
 
         # instantiate mapnik (used as renderer) with web mercator projection
@@ -44,10 +116,26 @@ class SurfaceRenderer:
         self._map = _map
         self.obj = obj
 
+        # without background (tileserver skipped or unavailable) only the
+        # features are rendered on white
+        self.background = background
+        self.degraded = False
+
+        # fetch the background while mapnik renders (config and size are
+        # captured here, mapnik objects are not shared with the thread)
+        self._background = None
+        if background:
+            app = current_app._get_current_object()
+            self._background = _submit(_fetch_background, app, obj['theme'],
+                                       obj['bbox'], width, height)
+
         # add features and overlay layers+styles
-        self._add_layer("styles/grid.xml", self.obj['grid'])
-        self._add_layer("styles/features.xml", self._get_features())
-        self._add_layer("styles/overlay.xml", self._get_overlay())
+        self._add_layer("grid.xml", self.obj['grid'])
+        self._add_layer("features.xml", self._get_features())
+        self._add_layer("overlay.xml", self._get_overlay())
+
+        # seconds per stage of the rendering
+        self.timings = {'setup': time.perf_counter() - start}
 
     @property
     def width(self):
@@ -62,8 +150,7 @@ class SurfaceRenderer:
             datasources = [datasources]
 
         idx = len(self._map.layers)
-        current_dir = pathlib.Path(__file__).parent
-        mapnik.load_map(self._map, str(current_dir / '..' / filename))
+        mapnik.load_map_from_string(self._map, _style(filename), False, STYLES_DIR)
 
         for ds in datasources:
             data = mapnik.Datasource(type='geojson', inline=json.dumps(ds))
@@ -97,27 +184,41 @@ class SurfaceRenderer:
         return [collection_scalebar, collection_copyright]
 
     def _get_background(self):
-        bbox = ','.join(str(x) for x in self.obj['bbox'])
-        renderer_url = current_app.config['MAP_RENDERER'][self.obj['theme']]
-        url = renderer_url.format(bbox, self.width, self.height)
-        response = requests.get(url, stream=True)
-        if (response.status_code != 200):
+        """Waits for the background fetched since construction"""
+        if not self._background:
             return None
-        return cairo.ImageSurface.create_from_png(response.raw)
+        surface, self.timings['background'] = self._background.result()
+        return surface
 
     def render(self, mimetype='image/png', scale=1):
         # render our map
+        start = time.perf_counter()
         surface_features = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
         mapnik.render(self._map, surface_features)
+        self.timings['mapnik'] = time.perf_counter() - start
 
         # merge map background and the map itself
+        start = time.perf_counter()
+        surface_background = self._get_background()
+        self.timings['background_wait'] = time.perf_counter() - start
+
+        start = time.perf_counter()
         width, height = [int(n*scale) for n in [self.width, self.height]]
         surface_merged = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
         merger = SurfaceMerger(surface_merged)
-        merger.add_surface(self._get_background())
+        if surface_background is None:
+            # missing although requested (tileserver unavailable)
+            self.degraded = self.background
+            merger.fill((1, 1, 1))
+        merger.add_surface(surface_background)
         merger.add_surface(surface_features)
+        f = merger.write(mimetype)
+        self.timings['merge'] = time.perf_counter() - start
 
-        return merger.write(mimetype)
+        current_app.logger.info('Rendered map %s (%s): %s', self.obj.get('id'), mimetype,
+                                ', '.join('{} {:.3f}s'.format(stage, seconds)
+                                          for (stage, seconds) in self.timings.items()))
+        return f
 
 
 class SurfaceMerger:
@@ -142,7 +243,15 @@ class SurfaceMerger:
         for surface in surfaces:
             self.add_surface(surface)
 
+    def fill(self, rgb):
+        with self.scoped():
+            self.ctx.set_source_rgb(*rgb)
+            self.ctx.paint()
+
     def add_surface(self, surface, alpha=None):
+        if surface is None:
+            return
+
         with self.scoped():
             scale_x = self.width/surface.get_width()
             scale_y = self.height/surface.get_height()
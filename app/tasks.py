@@ -1,9 +1,10 @@
 import os
 
-from tempfile import NamedTemporaryFile
 from flask import current_app, has_app_context
 from app.surface import SurfaceRenderer
-from app.utils import file_exists, get_file_info
+from app.compress import COMPRESSIBLE, write_sidecars
+from app.utils import file_exists, get_file_info, write_atomically,\
+                      degraded_marker, is_degraded
 
 
 def render_map(data, file_type, force=False):
@@ -18,8 +19,8 @@ def render_map(data, file_type, force=False):
     version = data['version']
     file_info = get_file_info(map_id, version, file_type)
 
-    # if map already is rendered, do nothing
-    if not force and file_exists(file_info):
+    # if map already is rendered (with background), do nothing
+    if not force and file_exists(file_info) and not is_degraded(file_info):
         return
 
     static_dir = current_app.static_folder
@@ -29,12 +30,17 @@ def render_map(data, file_type, force=False):
     renderer = SurfaceRenderer(data)
     data = renderer.render(file_info['mimetype']).read()
 
-    # write file atomically (otherwise we end up in serving incomplete files)
     path = os.path.join(static_dir, file_info['path'])
-    with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as tmp_f:
-        tmp_f.write(data)
-        tmp_f.flush()
-        os.replace(tmp_f.name, path)
+    write_atomically(path, [data])
+
+    if renderer.degraded:
+        write_atomically(degraded_marker(path), [])
+    elif os.path.exists(degraded_marker(path)):
+        os.unlink(degraded_marker(path))
+
+    # compress once, served by map_download for clients accepting it
+    if file_info['mimetype'] in COMPRESSIBLE:
+        write_sidecars(path)
 
     # update latest symlink to this
     symlink_name = 'LATEST'+file_info['suffix']
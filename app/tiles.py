@@ -0,0 +1,129 @@
+"""
+Backgrounds composed of standard z/x/y raster tiles (`MAP_TILES`).
+
+Instead of asking the tileserver for a bespoke image per map, the tiles
+covering the bbox of a map are fetched, cached in one MBTiles (SQLite) file
+per theme and composed, cropped and scaled locally with cairo. Maps covering
+the same area share their tiles.
+"""
+import math
+import os
+import sqlite3
+import cairo
+
+from contextlib import closing
+from io import BytesIO
+from flask import current_app
+from app import background
+
+TILE_SIZE = 256
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER,'
+    ' tile_row INTEGER, tile_data BLOB,'
+    ' PRIMARY KEY (zoom_level, tile_column, tile_row))'
+]
+
+
+class TileCache:
+    """Raster tiles of a theme stored as MBTiles (rows are in TMS order)"""
+
+    def __init__(self, filename, name):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=30)
+        # readers don't block the writer of another render worker
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+            self.db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)',
+                            ('name', name))
+            self.db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)',
+                            ('format', 'png'))
+
+    def close(self):
+        self.db.close()
+
+    def get(self, z, x, y):
+        row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND'
+                              ' tile_column=? AND tile_row=?',
+                              (z, x, (2 ** z) - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def set(self, z, x, y, data):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                            (z, x, (2 ** z) - 1 - y, data))
+
+
+def cache_filename(theme):
+    directory = current_app.config['TILES_CACHE_DIR'] or \
+        os.path.join(current_app.instance_path, 'tiles')
+    return os.path.join(directory, theme + '.mbtiles')
+
+
+def to_pixels(lng, lat, z):
+    """Global pixel coordinates of a WGS84 coordinate at zoom level z"""
+    size = TILE_SIZE * 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lng + 180) / 360 * size
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * size
+    return x, y
+
+
+def zoom_for_bbox(bbox, width):
+    """Lowest zoom level providing at least `width` pixels for the bbox"""
+    min_x, _ = to_pixels(bbox[0], bbox[1], 0)
+    max_x, _ = to_pixels(bbox[2], bbox[3], 0)
+    z = math.ceil(math.log2(width / (max_x - min_x)))
+    return min(max(z, 0), current_app.config['TILES_MAX_ZOOM'])
+
+
+def get_tile(cache, theme, z, x, y):
+    data = cache.get(z, x, y)
+    if data is None:
+        url = current_app.config['MAP_TILES'][theme].format(z, x, y)
+        data = background.fetch(url)
+        if data:
+            cache.set(z, x, y, data)
+    return data
+
+
+def compose(theme, bbox, width, height):
+    """PNG data of the background of bbox (with size width x height)
+    composed of tiles, None if a tile is unavailable"""
+    z = zoom_for_bbox(bbox, width)
+    min_x, max_y = to_pixels(bbox[0], bbox[1], z)
+    max_x, min_y = to_pixels(bbox[2], bbox[3], z)
+
+    tiles_x = range(int(min_x // TILE_SIZE), int(max_x // TILE_SIZE) + 1)
+    tiles_y = range(int(min_y // TILE_SIZE), int(max_y // TILE_SIZE) + 1)
+
+    # compose all tiles first and scale them at once (otherwise the seams
+    # between tiles become visible)
+    mosaic = cairo.ImageSurface(cairo.FORMAT_ARGB32, len(tiles_x) * TILE_SIZE,
+                                len(tiles_y) * TILE_SIZE)
+    ctx = cairo.Context(mosaic)
+    with closing(TileCache(cache_filename(theme), theme)) as cache:
+        for i, x in enumerate(tiles_x):
+            for j, y in enumerate(tiles_y):
+                data = get_tile(cache, theme, z, x, y)
+                if data is None:
+                    return None
+                tile = cairo.ImageSurface.create_from_png(BytesIO(data))
+                ctx.set_source_surface(tile, i * TILE_SIZE, j * TILE_SIZE)
+                ctx.paint()
+
+    # crop and scale to bbox
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    ctx = cairo.Context(surface)
+    ctx.scale(width / (max_x - min_x), height / (max_y - min_y))
+    ctx.translate(tiles_x[0] * TILE_SIZE - min_x, tiles_y[0] * TILE_SIZE - min_y)
+    ctx.set_source_surface(mosaic)
+    ctx.get_source().set_extend(cairo.EXTEND_PAD)
+    ctx.paint()
+
+    f = BytesIO()
+    surface.write_to_png(f)
+    return f.getvalue()
@@ -0,0 +1,126 @@
+"""
+Stateless edit tokens.
+
+A token carries the map id, its expiry and the secret generation of the map
+and is signed with a server key (`TOKEN_KEYS`, the first key signs new tokens,
+all keys are accepted). Tokens can therefore be verified without loading the
+map. Rotating the secret of a map increments its generation which revokes all
+previously issued tokens. Current generations are kept in a redis hash and
+cached for `TOKEN_REVOCATION_TTL` seconds per process.
+
+Keys equal to the placeholder `SECRET_KEY` of the default config (which is
+public) never sign nor verify tokens. Without a usable key maps issue tokens
+signed with their own secret instead (see `Map.gen_token`).
+"""
+import time
+
+from uuid import UUID
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from app.settings import DefaultConfig
+
+PREFIX = 'v2'
+GENERATIONS_KEY = 'map-token-generations'
+
+_generations = {}  # map id -> (generation, time of lookup)
+
+
+def _serializer(key):
+    return URLSafeSerializer(key, salt='map-token')
+
+
+def _redis():
+    return current_app.task_queue.connection
+
+
+def _normalize(map_id):
+    try:
+        return UUID(str(map_id)).hex
+    except ValueError:
+        return None
+
+
+def keys():
+    """Configured (key id, key) pairs usable for signing"""
+    return [(kid, key) for (kid, key) in current_app.config['TOKEN_KEYS']
+            if key and key != DefaultConfig.SECRET_KEY]
+
+
+def is_stateless(token):
+    return isinstance(token, str) and token.startswith(PREFIX + '.')
+
+
+def dumps(map_id, generation):
+    if not keys():
+        raise RuntimeError('No usable TOKEN_KEYS configured')
+    kid, key = keys()[0]
+    expires = int(time.time()) + current_app.config['TOKEN_EXPIRES_IN']
+    payload = {'m': _normalize(map_id), 'e': expires, 'g': generation}
+    return '.'.join([PREFIX, kid, _serializer(key).dumps(payload)])
+
+
+def loads(token):
+    """Returns the payload of a correctly signed and not expired token"""
+    try:
+        _, kid, data = token.split('.', 2)
+        key = dict(keys())[kid]
+        payload = _serializer(key).loads(data)
+    except (ValueError, KeyError, BadSignature):
+        return None
+
+    if payload['e'] < time.time():
+        return None
+    return payload
+
+
+def generation(map_id, cached=True):
+    """Current secret generation of a map. Looked up in redis (and only once
+    per map in the database) and cached shortly in memory."""
+    now = time.monotonic()
+    entry = _generations.get(map_id)
+    if cached and entry and now - entry[1] < current_app.config['TOKEN_REVOCATION_TTL']:
+        return entry[0]
+
+    value = _redis().hget(GENERATIONS_KEY, map_id)
+    if value is None:
+        from app.models import db, Map
+        value = db.session.query(Map.secret_generation) \
+                          .filter(Map.uuid == map_id) \
+                          .scalar()
+        if value is None:
+            return None  # map does not exist
+        _redis().hset(GENERATIONS_KEY, map_id, value)
+
+    if len(_generations) > 10000:
+        _generations.clear()
+    _generations[map_id] = (int(value), now)
+    return int(value)
+
+
+def check(token, map_id):
+    """Verifies a stateless token for a map"""
+    map_id = _normalize(map_id)
+    payload = loads(token)
+    if not map_id or not payload or payload['m'] != map_id:
+        return False
+
+    current = generation(map_id)
+    if current is not None and payload['g'] > current:
+        # issued after a rotation this process has not noticed yet
+        current = generation(map_id, cached=False)
+    return current is not None and payload['g'] == current
+
+
+def revoke(map_id, generation):
+    """Publishes a new secret generation, revoking older tokens"""
+    map_id = _normalize(map_id)
+    _redis().hset(GENERATIONS_KEY, map_id, generation)
+    _generations[map_id] = (generation, time.monotonic())
+
+
+def forget(map_ids):
+    map_ids = [_normalize(map_id) for map_id in map_ids]
+    if map_ids:
+        _redis().hdel(GENERATIONS_KEY, *map_ids)
+    for map_id in map_ids:
+        _generations.pop(map_id, None)
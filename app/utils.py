@@ -1,9 +1,15 @@
 import mimetypes
 import math
+import json
+import re
 
-from os import path
+from os import path, listdir, replace
+from shutil import rmtree
+from tempfile import NamedTemporaryFile
 from flask import current_app
+from functools import lru_cache
 from hashlib import sha256
+from pyproj import Transformer
 from math import floor, log10
 from haversine import haversine, Unit
 
@@ -14,6 +20,11 @@ try:
 except ImportError:
     pass
 
+try:
+    import topojson
+except ImportError:
+    topojson = None
+
 class InvalidUsage(Exception):
     status_code = 400
 
@@ -47,10 +58,88 @@ def strip(feature):
     return feature
 
 
+def normalize_style(props):
+    """Normalizes style properties of a feature in place: colors are hex
+    values (not rgb(r,g,b)) and weights integers"""
+    if 'iconColor' in props:
+        # ensure that we deal with hex values (not rgb(r,g,b))
+        if props['iconColor'].startswith('rgb'):
+            rgb = re.findall(r'\d+', props['iconColor'])
+            iconColor = ''.join([('%02x' % int(x)) for x in rgb])
+            props['iconColor'] = '#' + iconColor
+
+    if 'weight' in props:
+        props['weight'] = int(props['weight'])
+
+    return props
+
+
+@lru_cache()
+def wgs_to_merc():
+    """Transformer from WGS84 to web mercator (expensive to create, hence
+    shared). Use pyproj as mapnik is built without proj4 support."""
+    return Transformer.from_crs(4326, 3857, always_xy=True)
+
+
+def degraded_marker(file_name):
+    """Marker of a rendering without background (tileserver unavailable),
+    which is served but rendered again on the next render request"""
+    return file_name + '.degraded'
+
+
 def file_exists(file_info):
     file_name = path.join(current_app.static_folder, file_info['path'])
     return path.exists(file_name)
 
+
+def is_degraded(file_info):
+    file_name = path.join(current_app.static_folder, file_info['path'])
+    return path.exists(degraded_marker(file_name))
+
+def rendered_dir(map_id):
+    """Absolute path of the directory containing all renderings of a map"""
+    dirname = sha256(map_id.encode()).hexdigest()
+    return path.join(current_app.static_folder, 'maps', dirname)
+
+
+def remove_rendered(map_id):
+    rmtree(rendered_dir(map_id), ignore_errors=True)
+
+
+def remove_orphaned_rendered(map_ids, before=None):
+    """Removes rendering directories of maps which are not in `map_ids`
+    anymore and returns their number. Directories modified after `before`
+    (timestamp, e.g. when `map_ids` were queried) are kept, they may belong
+    to maps created meanwhile."""
+    maps_dir = path.join(current_app.static_folder, 'maps')
+    if not path.isdir(maps_dir):
+        return 0
+
+    existing = set(sha256(map_id.encode()).hexdigest() for map_id in map_ids)
+    orphaned = [d for d in listdir(maps_dir) if d not in existing]
+    removed = 0
+    for dirname in orphaned:
+        dirname = path.join(maps_dir, dirname)
+        try:
+            if before is not None and path.getmtime(dirname) >= before:
+                continue
+        except FileNotFoundError:
+            continue
+        rmtree(dirname, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def write_atomically(filename, chunks):
+    """Writes chunks (str or bytes) to a file atomically (otherwise we end up
+    in serving incomplete files)"""
+    with NamedTemporaryFile(dir=path.dirname(filename), delete=False) as tmp_f:
+        for chunk in chunks:
+            tmp_f.write(chunk.encode() if isinstance(chunk, str) else chunk)
+        tmp_f.flush()
+        replace(tmp_f.name, filename)
+
+
 def get_img_type(file_type):
     if ':' in file_type:
         img_type, size = file_type.split(':')
@@ -130,3 +219,53 @@ def get_size(bbox_width, bbox_height):
     else:
         width = int(round(height*math.pow(ratio,-1)))
     return (width, height)
+
+
+def _chunked(parts, chunk_size=64*1024):
+    buf, size = [], 0
+    for part in parts:
+        buf.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def stream_feature_collection(features, properties=None):
+    """
+    Encodes an iterable of already serialized GeoJSON features incrementally
+    as FeatureCollection (optionally with properties).
+    """
+    def gen():
+        yield '{"type":"FeatureCollection",'
+        if properties is not None:
+            yield '"properties":' + json.dumps(properties) + ','
+        yield '"features":['
+        for i, feature in enumerate(features):
+            yield feature if i == 0 else ',' + feature
+        yield ']}'
+    return _chunked(gen())
+
+
+def feature_topology(features, properties=None):
+    """
+    Encodes already serialized GeoJSON features as TopoJSON topology (with
+    arcs shared between adjacent features). Requires the optional `topojson`
+    package.
+    """
+    collection = {
+        'type': 'FeatureCollection',
+        'features': [json.loads(feature) for feature in features]
+    }
+    topology = topojson.Topology(collection, prequantize=True,
+                                 object_name='features').to_dict()
+    if properties is not None:
+        topology['properties'] = properties
+    return json.dumps(topology)
+
+
+def stream_ndjson(features):
+    """Encodes already serialized GeoJSON features as newline delimited JSON"""
+    return _chunked(feature + '\n' for feature in features)
@@ -7,6 +7,6 @@ done
 
 flask db upgrade
 
-rq worker --url "redis://${REDIS_HOST}" &
+flask render-worker &
 
 gunicorn --worker-class eventlet -w 1 "app:create_app()" --bind 0.0.0.0:5000
@@ -0,0 +1,41 @@
+"""Persisted map version and feature content hashes.
+
+Revision ID: 3b8e5d2a9c71
+Revises: f4af901bc63c
+Create Date: 2026-10-18 10:12:41.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8e5d2a9c71'
+down_revision = 'f4af901bc63c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('map', sa.Column('_version', sa.Unicode(), nullable=True))
+    op.add_column('feature', sa.Column('_hash', sa.Unicode(), nullable=True))
+
+    # Backfill existing rows. The hashes differ from the ones computed by the
+    # app, but they only need to change whenever the content changes. The
+    # first edit of a map replaces its root hash with one computed by the app.
+    op.execute("""
+        UPDATE feature SET _hash = encode(sha256(convert_to(
+            concat(ST_AsEWKT(_geo), '|', style::text), 'UTF8')), 'hex')
+    """)
+    op.execute("""
+        UPDATE map SET _version = encode(sha256(convert_to(concat_ws('|',
+            name, description, place, _datetime, ST_AsEWKT(_bbox),
+            attributes::text, published, lifespan, theme,
+            (SELECT string_agg(concat(f.id, ':', f._hash), ',' ORDER BY f.id)
+             FROM feature f WHERE f.map_uuid = map.uuid)), 'UTF8')), 'hex')
+    """)
+
+
+def downgrade():
+    op.drop_column('feature', '_hash')
+    op.drop_column('map', '_version')
@@ -0,0 +1,29 @@
+"""Spatial indexes on map and feature geometries.
+
+Revision ID: 5e07b3a1f8c9
+Revises: c42a7e9f1d03
+Create Date: 2026-10-18 13:21:54.007326
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e07b3a1f8c9'
+down_revision = 'c42a7e9f1d03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # same names geoalchemy2 uses, which may already have created them
+    op.execute("CREATE INDEX IF NOT EXISTS idx_map__bbox ON map USING gist (_bbox)")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_feature__geo ON feature USING gist (_geo)")
+    op.create_index('ix_feature_map_uuid', 'feature', ['map_uuid'])
+
+
+def downgrade():
+    op.drop_index('ix_feature_map_uuid', table_name='feature')
+    op.execute("DROP INDEX IF EXISTS idx_feature__geo")
+    op.execute("DROP INDEX IF EXISTS idx_map__bbox")
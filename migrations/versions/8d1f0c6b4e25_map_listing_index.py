@@ -0,0 +1,24 @@
+"""Composite index for keyset pagination of the map listing.
+
+Revision ID: 8d1f0c6b4e25
+Revises: 3b8e5d2a9c71
+Create Date: 2026-10-18 11:02:09.551873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d1f0c6b4e25'
+down_revision = '3b8e5d2a9c71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_map_datetime_uuid', 'map', ['_datetime', 'uuid'])
+
+
+def downgrade():
+    op.drop_index('ix_map_datetime_uuid', table_name='map')
@@ -0,0 +1,28 @@
+"""Delete features of a map in the database (ON DELETE CASCADE).
+
+Revision ID: 9a6c2f4d7b10
+Revises: 5e07b3a1f8c9
+Create Date: 2026-10-18 14:05:12.660194
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6c2f4d7b10'
+down_revision = '5e07b3a1f8c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('feature_map_uuid_fkey', 'feature', type_='foreignkey')
+    op.create_foreign_key('feature_map_uuid_fkey', 'feature', 'map',
+                          ['map_uuid'], ['uuid'], ondelete='CASCADE')
+
+
+def downgrade():
+    op.drop_constraint('feature_map_uuid_fkey', 'feature', type_='foreignkey')
+    op.create_foreign_key('feature_map_uuid_fkey', 'feature', 'map',
+                          ['map_uuid'], ['uuid'])
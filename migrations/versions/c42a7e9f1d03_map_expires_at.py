@@ -0,0 +1,36 @@
+"""Materialized map expiry and partial listing index.
+
+Revision ID: c42a7e9f1d03
+Revises: 8d1f0c6b4e25
+Create Date: 2026-10-18 11:47:30.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c42a7e9f1d03'
+down_revision = '8d1f0c6b4e25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('map', sa.Column('expires_at', sa.DateTime(timezone=True),
+                                   nullable=True))
+    op.execute("UPDATE map SET expires_at = _datetime + lifespan")
+
+    op.drop_index('ix_map_datetime_uuid', table_name='map')
+    op.create_index('ix_map_published_datetime_uuid', 'map',
+                    ['_datetime', 'uuid'],
+                    postgresql_where=sa.text('published IS true AND '
+                                             '_bbox IS NOT NULL'))
+    op.create_index('ix_map_expires_at', 'map', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_map_expires_at', table_name='map')
+    op.drop_index('ix_map_published_datetime_uuid', table_name='map')
+    op.create_index('ix_map_datetime_uuid', 'map', ['_datetime', 'uuid'])
+    op.drop_column('map', 'expires_at')
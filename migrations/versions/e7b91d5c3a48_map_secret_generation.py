@@ -0,0 +1,25 @@
+"""Secret generation of maps for stateless tokens.
+
+Revision ID: e7b91d5c3a48
+Revises: 9a6c2f4d7b10
+Create Date: 2026-10-18 15:10:37.912845
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b91d5c3a48'
+down_revision = '9a6c2f4d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('map', sa.Column('secret_generation', sa.Integer(),
+                                   server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('map', 'secret_generation')
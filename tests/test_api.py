@@ -1,10 +1,12 @@
 import datetime
 import pytz
 from tests.fixtures import *
-from tests.utils import db_reset
-from json import dumps as json_dump
+from tests.utils import db_reset, count_queries
+from json import dumps as json_dump, loads as json_load
 from geojson import Feature as GeoFeature, Point as GeoPoint
 from app.models import Map, Feature, db as _db
+from app.utils import rendered_dir
+from os import makedirs, path
 
 def setup_function(function):
     db_reset()
@@ -75,6 +77,104 @@ def test_maps_list(app, db):
     assert(_count_maps(app) == 1)
 
 
+def test_maps_list_pagination(app, db):
+    uuids = _create_published_maps(db, 5)
+
+    seen = []
+    with app.test_client() as client:
+        url = '/api/maps?limit=2'
+        while url:
+            resp = client.get(url)
+            assert(resp.status_code == 200)
+            assert(len(resp.json) <= 2)
+            seen.extend(m['id'] for m in resp.json)
+            url = None
+            if 'X-Next-Cursor' in resp.headers:
+                assert('rel="next"' in resp.headers['Link'])
+                url = '/api/maps?limit=2&cursor=' + resp.headers['X-Next-Cursor']
+
+        resp = client.get('/api/maps?cursor=INVALID')
+        assert(resp.status_code == 400)
+
+    assert(sorted(seen) == sorted(uuids))
+    assert(len(seen) == len(set(seen)))
+
+
+def test_maps_list_bbox(app, db):
+    db.session.add(Map('foo-inside', published=True, bbox=[1, 1, 2, 2]))
+    db.session.add(Map('foo-outside', published=True, bbox=[10, 10, 11, 11]))
+    db.session.commit()
+
+    with app.test_client() as client:
+        resp = client.get('/api/maps?bbox=0,0,3,3')
+        assert(resp.status_code == 200)
+        assert([m['name'] for m in resp.json] == ['foo-inside'])
+
+        resp = client.get('/api/maps?bbox=0,0,3')
+        assert(resp.status_code == 400)
+
+
+def test_maps_fields(app, db):
+    uuid, = _create_published_maps(db, 1, features_per_map=1)
+
+    with app.test_client() as client:
+        resp = client.get('/api/maps?fields=name,place,datetime')
+        assert(resp.status_code == 200)
+        assert(set(resp.json[0]) == {'name', 'place', 'datetime'})
+
+        resp = client.get('/api/maps?fields=features')
+        assert(resp.status_code == 400)
+
+        resp = client.get('/api/maps?fields=secret')
+        assert(resp.status_code == 400)
+
+        resp = client.get('/api/maps/{}?fields=id,grid,features'.format(uuid))
+        assert(resp.status_code == 200)
+        assert(set(resp.json) == {'id', 'grid', 'features'})
+        assert(len(resp.json['features']) == 1)
+
+
+def test_maps_list_cache(app, db):
+    app.config['LISTING_CACHE_TTL'] = 60
+    try:
+        uuid, = _create_published_maps(db, 1)
+        with app.test_client() as client:
+            resp = client.get('/api/maps')
+            assert([m['id'] for m in resp.json] == [uuid])
+
+            # served from cache (no database access)
+            with count_queries() as statements:
+                resp = client.get('/api/maps')
+            assert(len(statements) == 0)
+            assert([m['id'] for m in resp.json] == [uuid])
+
+            # invalidated by model signals
+            m = Map.get(uuid)
+            m.name = 'bar-cached'
+            db.session.add(m)
+            db.session.commit()
+            resp = client.get('/api/maps')
+            assert(resp.json[0]['name'] == 'bar-cached')
+
+            # changes of unlisted maps keep the cache
+            from app import cache
+            connection = app.task_queue.connection
+            generation = connection.get(cache.GENERATION_KEY)
+            private = Map('foo-private', bbox=[1, 1, 2, 2])
+            db.session.add(private)
+            db.session.commit()
+            private.features.append(Feature(GeoFeature(geometry=GeoPoint([1, 1]))))
+            db.session.commit()
+            assert(connection.get(cache.GENERATION_KEY) == generation)
+
+            # but publishing one invalidates it
+            private.published = True
+            db.session.commit()
+            assert(connection.get(cache.GENERATION_KEY) != generation)
+    finally:
+        app.config['LISTING_CACHE_TTL'] = 0
+
+
 def test_maps_new_private(app, db):
     name = 'foo-new-private'
     uuid, token = _create_map(app, {'name': name})
@@ -98,6 +198,71 @@ def test_maps_new_private(app, db):
     assert(resp.status_code == 200)
 
 
+def test_stateless_token(app, db):
+    uuid, token = _create_map(app, {'name': 'foo-token'})
+    other, other_token = _create_map(app, {'name': 'foo-token-other'})
+
+    # verified without loading the map (once the generation of the map is
+    # known)
+    assert(Map.get(uuid).check_token(token))
+    url = '/api/maps/{}'.format(uuid)
+    headers = {'X-MAP': uuid, 'X-TOKEN': token}
+    with count_queries() as statements:
+        with app.test_request_context(url, headers=headers):
+            from app.api import auth
+            assert(auth())
+    assert(len(statements) == 0)
+
+    # tokens only authorize their own map
+    resp = _update_map(app, other, token, {'name': 'bar'})
+    assert(resp.status_code == 401)
+    with app.test_client() as client:
+        url = '/api/maps/{}'.format(other)
+        headers = {'X-MAP': uuid, 'X-TOKEN': token}
+        resp = client.patch(url, json={'name': 'bar'}, headers=headers)
+        assert(resp.status_code == 401)
+
+    # rotating the secret revokes all tokens
+    m = Map.get(uuid)
+    with app.test_client() as client:
+        url = '/api/maps/{}/secret'.format(uuid)
+        resp = client.post(url, headers={'X-SECRET': m.secret})
+        assert(resp.status_code == 200)
+        new_token = resp.json['token']
+
+    assert(not Map.get(uuid).check_token(token))
+    assert(Map.get(uuid).check_token(new_token))
+    assert(Map.get(other).check_token(other_token))
+    resp = _update_map(app, uuid, token, {'name': 'bar'})
+    assert(resp.status_code == 401)
+    resp = _update_map(app, uuid, new_token, {'name': 'bar'})
+    assert(resp.status_code == 200)
+
+
+def test_token_forgery(app, db, monkeypatch):
+    from app import tokens
+    from app.settings import DefaultConfig
+    from itsdangerous import URLSafeSerializer
+    uuid, token = _create_map(app, {'name': 'foo-forgery'})
+
+    # tokens claiming a future generation are not accepted
+    kid, key = app.config['TOKEN_KEYS'][0]
+    payload = {'m': uuid, 'e': 2 ** 40, 'g': 1}
+    data = URLSafeSerializer(key, salt='map-token').dumps(payload)
+    assert(not Map.get(uuid).check_token('.'.join([tokens.PREFIX, kid, data])))
+
+    # the public placeholder key neither signs nor verifies tokens
+    monkeypatch.setitem(app.config, 'TOKEN_KEYS', [('1', DefaultConfig.SECRET_KEY)])
+    payload['g'] = 0
+    data = URLSafeSerializer(DefaultConfig.SECRET_KEY, salt='map-token').dumps(payload)
+    assert(not Map.get(uuid).check_token('.'.join([tokens.PREFIX, '1', data])))
+
+    # maps sign with their own secret instead
+    token = Map.get(uuid).gen_token()
+    assert(not tokens.is_stateless(token))
+    assert(Map.get(uuid).check_token(token))
+
+
 def test_maps_new_public(app, db):
     m = Map('foo-new-public', bbox=[1, 1, 1, 1])
     db.session.add(m)
@@ -170,16 +335,59 @@ def test_map_lifespan(app, db):
     resp = _get_map(app, m.uuid, token)
     assert(resp.status_code == 200)
 
+    assert(m.expires_at == m.datetime + m.lifespan)
+    assert(len(Map.all()) == 1)
+
     m.datetime = now - datetime.timedelta(days=31)
     db.session.add(m)
     db.session.commit()
 
     assert(m.outdated)
+    assert(m.expires_at == m.datetime + m.lifespan)
+    assert(len(Map.all()) == 0)
+    assert(db.session.query(Map).filter(Map.outdated).count() == 1)
 
     resp = _get_map(app, m.uuid, token)
     assert(resp.status_code == 404)
 
 
+def test_purge_outdated(app, db):
+    now = datetime.datetime.utcnow()
+    old = now - datetime.timedelta(days=31)
+    uuids = _create_published_maps(db, 3, features_per_map=2)
+    for uuid in uuids[:2]:
+        Map.get(uuid).datetime = old
+        makedirs(rendered_dir(uuid), exist_ok=True)
+    db.session.commit()
+
+    purged = [uuid for chunk in Map.purge_outdated(batch_size=1) for uuid in chunk]
+    assert(sorted(purged) == sorted(uuids[:2]))
+
+    db.session.expire_all()
+    assert(Map.get(uuids[2]))
+    assert(not any(Map.get(uuid) for uuid in uuids[:2]))
+    assert(db.session.query(Feature).count() == 2)
+    assert(not any(path.exists(rendered_dir(uuid)) for uuid in uuids[:2]))
+
+
+def test_remove_orphaned_rendered(app, db):
+    import os
+    import time
+    from app.utils import remove_orphaned_rendered
+    uuid, = _create_published_maps(db, 1)
+    orphaned, created = 'a' * 32, 'b' * 32
+    for map_id in [uuid, orphaned, created]:
+        makedirs(rendered_dir(map_id), exist_ok=True)
+
+    # directories modified after the purge started belong to new maps
+    started = time.time() - 60
+    os.utime(rendered_dir(orphaned), (started - 60, started - 60))
+    assert(remove_orphaned_rendered([uuid], started) >= 1)
+    assert(not path.exists(rendered_dir(orphaned)))
+    assert(path.exists(rendered_dir(created)))
+    assert(path.exists(rendered_dir(uuid)))
+
+
 def test_feature(app, db):
     assert(_count_maps(app) == 0)
     name = 'foo'
@@ -200,6 +408,439 @@ def test_feature(app, db):
     assert(_count_maps(app) == 1)
 
 
+def test_map_version(app, db):
+    m = Map('foo-version', bbox=[1, 1, 1, 1])
+    db.session.add(m)
+    db.session.commit()
+
+    versions = [m.version]
+    assert(m.version == m.compute_version())
+
+    f = Feature(GeoFeature(geometry=GeoPoint([1, 1])))
+    m.features.append(f)
+    db.session.add(m)
+    db.session.commit()
+    versions.append(m.version)
+
+    f.style = {'color': 'red'}
+    db.session.add(f)
+    db.session.commit()
+    versions.append(m.version)
+
+    m.name = 'bar-version'
+    db.session.add(m)
+    db.session.commit()
+    versions.append(m.version)
+
+    db.session.delete(f)
+    db.session.commit()
+    versions.append(m.version)
+
+    assert(len(set(versions)) == len(versions))
+    assert(m.version == m.compute_version())
+
+    # reading does not change the version
+    resp = _get_map(app, m.uuid, m.gen_token())
+    assert(resp.json['version'] == m.version)
+
+
+def _create_published_maps(db, n, features_per_map=0):
+    maps = []
+    for i in range(n):
+        m = Map('foo-{}'.format(i), published=True, bbox=[1, 1, 2, 2])
+        for j in range(features_per_map):
+            point = GeoFeature(geometry=GeoPoint([1, 1 + j/100.]))
+            m.features.append(Feature(point))
+        db.session.add(m)
+        maps.append(m)
+    db.session.commit()
+    return [m.uuid.hex for m in maps]
+
+
+QUERY_BUDGET = {
+    'maps': 1,
+    'map_features': 2,
+    'map_export_geojson': 2
+}
+
+
+def test_query_budget_maps(app, db):
+    counts = []
+    for n in [5, 50]:
+        db_reset()
+        _create_published_maps(db, n, features_per_map=2)
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get('/api/maps')
+            assert(resp.status_code == 200)
+            assert(len(resp.json) == n)
+        counts.append(len(statements))
+
+    assert(counts[0] == counts[1])
+    assert(counts[0] <= QUERY_BUDGET['maps'])
+
+
+def test_query_budget_features(app, db):
+    for endpoint in ['map_features', 'map_export_geojson']:
+        suffix = 'features' if endpoint == 'map_features' else 'geojson'
+        counts = []
+        for n in [2, 20]:
+            uuid, = _create_published_maps(db, 1, features_per_map=n)
+            with app.test_client() as client:
+                url = '/api/maps/{}/{}'.format(uuid, suffix)
+                with count_queries() as statements:
+                    resp = client.get(url)
+                assert(resp.status_code == 200)
+                assert(len(resp.json['features']) == n)
+            counts.append(len(statements))
+
+        assert(counts[0] == counts[1])
+        assert(counts[0] <= QUERY_BUDGET[endpoint])
+
+
+def test_features_geojson(app, db):
+    uuid, = _create_published_maps(db, 1, features_per_map=3)
+    m = Map.get(uuid)
+    m.features[0].style = {'color': 'red'}
+    db.session.add(m)
+    db.session.commit()
+
+    expected = json_load(json_dump([f.to_dict() for f in m.features]))
+    with app.test_client() as client:
+        resp = client.get('/api/maps/{}/features'.format(uuid))
+        assert(resp.status_code == 200)
+        assert(resp.json['type'] == 'FeatureCollection')
+        assert(resp.json['features'] == expected)
+        assert('Accept' in resp.vary)
+
+        resp = client.get('/api/maps/{}/geojson'.format(uuid))
+        assert(resp.status_code == 200)
+        assert(resp.json['features'] == expected)
+        assert('Accept' in resp.vary)
+        assert(resp.json['properties']['id'] == uuid)
+
+        url = '/api/maps/{}/features?format=ndjson'.format(uuid)
+        resp = client.get(url)
+        assert(resp.status_code == 200)
+        assert(resp.mimetype == 'application/x-ndjson')
+        lines = resp.data.decode().splitlines()
+        assert([json_load(line) for line in lines] == expected)
+
+        url = '/api/maps/{}/features?bbox=0.5,0.5,1.005,1.005'.format(uuid)
+        resp = client.get(url)
+        assert(resp.status_code == 200)
+        assert(resp.json['features'] == expected[:1])
+
+
+def test_features_precision(app, db):
+    uuid, token = _create_map(app, {'name': 'foo-precision', 'bbox': [1, 1, 2, 2]})
+    headers = {'X-MAP': uuid, 'X-TOKEN': token}
+
+    with app.test_client() as client:
+        url = '/api/maps/{}/features'.format(uuid)
+        point = GeoFeature(geometry=GeoPoint([1.123456789, 1.987654321]))
+        resp = client.post(url, json=point, headers=headers)
+        assert(resp.status_code == 201)
+
+        resp = client.get(url, headers=headers)
+        coordinates = resp.json['features'][0]['geometry']['coordinates']
+        assert(coordinates == [1.1234568, 1.9876543])
+
+        resp = client.get(url + '?precision=2', headers=headers)
+        coordinates = resp.json['features'][0]['geometry']['coordinates']
+        assert(coordinates == [1.12, 1.99])
+
+        resp = client.get(url + '?precision=99', headers=headers)
+        coordinates = resp.json['features'][0]['geometry']['coordinates']
+        assert(coordinates == [1.123456789, 1.987654321])
+
+        resp = client.get(url + '?format=topojson', headers=headers)
+        assert(resp.status_code == 200)
+        assert(resp.json['type'] == 'Topology')
+        assert('features' in resp.json['objects'])
+
+        resp = client.get(url + '?format=kml', headers=headers)
+        assert(resp.status_code == 400)
+
+
+def test_vector_tiles(app, db):
+    uuid, = _create_published_maps(db, 1, features_per_map=1)
+
+    with app.test_client() as client:
+        url = '/api/maps/{}/tiles/{}/{}/{}.mvt'
+        resp = client.get(url.format(uuid, 0, 0, 0))
+        assert(resp.status_code == 200)
+        assert(resp.mimetype == 'application/vnd.mapbox-vector-tile')
+        assert(b'features' in resp.data)
+
+        etag = resp.headers['ETag']
+        resp = client.get(url.format(uuid, 0, 0, 0), headers={'If-None-Match': etag})
+        assert(resp.status_code == 304)
+
+        # the feature is around (1, 1), far away from the north west corner
+        resp = client.get(url.format(uuid, 10, 0, 0))
+        assert(resp.status_code == 200)
+        assert(resp.data == b'')
+
+        resp = client.get(url.format(uuid, 1, 2, 0))
+        assert(resp.status_code == 404)
+
+
+def test_binary_export(app, db):
+    uuid, = _create_published_maps(db, 1, features_per_map=3)
+
+    with app.test_client() as client:
+        url = '/api/maps/{}/export.fgb'.format(uuid)
+        resp = client.get(url)
+        assert(resp.status_code == 200)
+        assert(resp.mimetype == 'application/flatgeobuf')
+        assert(resp.data.startswith(b'fgb\x03'))
+
+        url = '/api/maps/{}/geojson'.format(uuid)
+        resp = client.get(url, headers={'Accept': 'application/flatgeobuf'})
+        assert(resp.status_code == 200)
+        assert(resp.data.startswith(b'fgb\x03'))
+        assert('Accept' in resp.vary)
+
+        url = '/api/maps/{}/export.pbf'.format(uuid)
+        resp = client.get(url)
+        assert(resp.status_code == 200)
+        assert(resp.mimetype == 'application/geobuf')
+        assert(resp.data)
+
+        url = '/api/maps/{}/export.geojson'.format(uuid)
+        resp = client.get(url)
+        assert(resp.status_code == 200)
+        assert(len(resp.json['features']) == 3)
+
+        url = '/api/maps/{}/export.kml'.format(uuid)
+        assert(client.get(url).status_code == 404)
+
+
+def test_postgis_requirements(app, db, monkeypatch):
+    from app import models
+    uuid, = _create_published_maps(db, 1, features_per_map=1)
+    monkeypatch.setattr(models, '_postgis_version', (2, 5, 0))
+
+    with app.test_client() as client:
+        resp = client.get('/api/maps/{}/tiles/0/0/0.mvt'.format(uuid))
+        assert(resp.status_code == 404)
+        resp = client.get('/api/maps/{}/export.fgb'.format(uuid))
+        assert(resp.status_code == 406)
+        resp = client.get('/api/maps/{}/export.pbf'.format(uuid))
+        assert(resp.status_code == 200)
+
+
+def test_map_request_cache(app, db):
+    uuid, token = _create_map(app, {'name': 'foo-cache', 'bbox': [1, 1, 2, 2]})
+    headers = {'X-MAP': uuid, 'X-TOKEN': token}
+
+    with app.test_client() as client:
+        url = '/api/maps/{}'.format(uuid)
+        with count_queries() as statements:
+            resp = client.patch(url, json={'name': 'bar-cache'}, headers=headers)
+        assert(resp.status_code == 200)
+        assert(resp.json['name'] == 'bar-cache')
+
+    selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')
+               and 'FROM map' in s and 'feature' not in s]
+    # one lookup plus one refresh after the commit
+    assert(len(selects) <= 2)
+
+
+def test_conditional_get(app, db):
+    uuid, = _create_published_maps(db, 1, features_per_map=2)
+
+    with app.test_client() as client:
+        for suffix in ['', '/features', '/geojson', '/grid']:
+            url = '/api/maps/{}{}'.format(uuid, suffix)
+            resp = client.get(url)
+            assert(resp.status_code == 200)
+            etag = resp.headers['ETag']
+
+            with count_queries() as statements:
+                resp = client.get(url, headers={'If-None-Match': etag})
+            assert(resp.status_code == 304)
+            assert(not resp.data)
+            assert(not any('FROM feature' in s for s in statements))
+
+        url = '/api/maps/{}/features'.format(uuid)
+        etag = client.get(url).headers['ETag']
+        ndjson = client.get(url, headers={'Accept': 'application/x-ndjson'})
+        assert(ndjson.headers['ETag'] != etag)
+
+        m = Map.get(uuid)
+        m.features[0].style = {'color': 'red'}
+        db.session.add(m)
+        db.session.commit()
+
+        resp = client.get(url, headers={'If-None-Match': etag})
+        assert(resp.status_code == 200)
+        assert(resp.headers['ETag'] != etag)
+
+
+def test_if_match(app, db):
+    uuid, token = _create_map(app, {'name': 'foo-if-match', 'bbox': [1, 1, 2, 2]})
+    headers = {'X-MAP': uuid, 'X-TOKEN': token}
+
+    with app.test_client() as client:
+        url = '/api/maps/{}/features'.format(uuid)
+        point = GeoFeature(geometry=GeoPoint([1, 1]))
+        feature_id = client.post(url, json=point, headers=headers).json['properties']['id']
+        version = Map.get(uuid).version
+
+        url = '/api/maps/{}'.format(uuid)
+        resp = client.patch(url, json={'name': 'bar'},
+                            headers={**headers, 'If-Match': '"{}"'.format(version)})
+        assert(resp.status_code == 200)
+        assert(resp.json['version'] != version)
+
+        # stale version
+        resp = client.patch(url, json={'name': 'baz'},
+                            headers={**headers, 'If-Match': '"{}"'.format(version)})
+        assert(resp.status_code == 412)
+        assert(resp.json['version'] == Map.get(uuid).version)
+        assert(resp.json['map']['name'] == 'bar')
+        assert(list(resp.json['features']) == [str(feature_id)])
+        feature = client.get('/api/maps/{}/features'.format(uuid)).json['features'][0]
+        assert(resp.json['features'][str(feature_id)] == feature['hash'])
+
+        url = '/api/maps/{}/features/{}'.format(uuid, feature_id)
+        resp = client.delete(url, headers={**headers, 'If-Match': '"{}"'.format(version)})
+        assert(resp.status_code == 412)
+        assert(resp.json['feature']['properties']['id'] == feature_id)
+        assert(Feature.get(feature_id))
+
+        # the ETag of a map resource works as well
+        etag = client.get('/api/maps/{}'.format(uuid), headers=headers).headers['ETag']
+        resp = client.delete(url, headers={**headers, 'If-Match': etag})
+        assert(resp.status_code == 200)
+
+
+def test_compression(app, db):
+    import gzip
+    uuid, = _create_published_maps(db, 1, features_per_map=50)
+
+    with app.test_client() as client:
+        for suffix in ['features', 'geojson']:
+            url = '/api/maps/{}/{}'.format(uuid, suffix)
+            plain = client.get(url)
+            assert('Content-Encoding' not in plain.headers)
+
+            resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert(resp.status_code == 200)
+            assert(resp.headers['Content-Encoding'] == 'gzip')
+            assert('Accept-Encoding' in resp.headers['Vary'])
+            assert(json_load(gzip.decompress(resp.data)) == plain.json)
+            assert(resp.headers['ETag'] != plain.headers['ETag'])
+
+    # the export is written once (with sidecars) per version
+    version = Map.get(uuid).version
+    export = path.join(rendered_dir(uuid), version + '.geojson')
+    assert(path.exists(export))
+    assert(path.exists(export + '.gz'))
+
+
+def test_features_batch(app, db):
+    uuid, token = _create_map(app, {'name': 'foo-batch', 'bbox': [1, 1, 2, 2]})
+    headers = {'X-MAP': uuid, 'X-TOKEN': token}
+    point = GeoFeature(geometry=GeoPoint([1, 1]))
+
+    with app.test_client() as client:
+        url = '/api/maps/{}/features'.format(uuid)
+        ids = [client.post(url, json=point, headers=headers).json['properties']['id']
+               for _ in range(2)]
+        version = Map.get(uuid).version
+
+        from app.live import socketio
+        socketio_client = socketio.test_client(app, flask_test_client=client)
+        socketio_client.emit('join', uuid)
+        socketio_client.get_received()
+
+        # invalid operations roll back the whole batch
+        url = '/api/maps/{}/features/batch'.format(uuid)
+        operations = [{'op': 'delete', 'id': ids[0]},
+                      {'op': 'update', 'id': -1, 'feature': point}]
+        resp = client.post(url, json={'operations': operations}, headers=headers)
+        assert(resp.status_code == 400)
+        assert([r['status'] for r in resp.json['results']] == [424, 404])
+        assert(Feature.get(ids[0]))
+
+        moved = GeoFeature(geometry=GeoPoint([2, 2]), properties={'weight': '3'})
+        operations = [{'op': 'create', 'feature': point},
+                      {'op': 'update', 'id': ids[0], 'feature': moved},
+                      {'op': 'delete', 'id': ids[1]}]
+        resp = client.post(url, json={'operations': operations}, headers=headers)
+        assert(resp.status_code == 200)
+        assert([r['status'] for r in resp.json['results']] == [201, 200, 204])
+        assert(resp.json['results'][1]['feature']['properties']['weight'] == 3)
+        assert(resp.json['version'] != version)
+        assert(not Feature.get(ids[1]))
+
+        r = socketio_client.get_received()
+        assert(len(r) == 1)
+        assert(r[0]['name'] == 'features-batch')
+        data = r[0]['args'][0]
+        assert(len(data['created']) == 1)
+        assert(len(data['updated']) == 1)
+        assert(len(data['deleted']) == 1)
+
+        # creates after updates and deletes still end up in one flush
+        created = resp.json['results'][0]['feature']['properties']['id']
+        operations = [{'op': 'update', 'id': created, 'feature': moved},
+                      {'op': 'delete', 'id': ids[0]},
+                      {'op': 'create', 'feature': point}]
+        resp = client.post(url, json={'operations': operations}, headers=headers)
+        assert(resp.status_code == 200)
+        assert(resp.json['version'] == Map.get(uuid).compute_version())
+
+        r = socketio_client.get_received()
+        assert(len(r) == 1)
+        data = r[0]['args'][0]
+        assert(len(data['created']) == 1)
+        assert(len(data['updated']) == 1)
+        assert(len(data['deleted']) == 1)
+
+        # malformed bodies and ids
+        resp = client.post(url, json=[], headers=headers)
+        assert(resp.status_code == 400)
+        operations = [{'op': 'delete', 'id': [created]}]
+        resp = client.post(url, json={'operations': operations}, headers=headers)
+        assert(resp.status_code == 400)
+
+
+def test_features_import(app, db):
+    uuid, token = _create_map(app, {'name': 'foo-import', 'bbox': [1, 1, 2, 2]})
+    headers = {'X-MAP': uuid, 'X-TOKEN': token}
+    version = Map.get(uuid).version
+
+    features = [GeoFeature(geometry=GeoPoint([1, 1 + i/100.]),
+                           properties={'label': str(i)}) for i in range(10)]
+    features[0]['properties'].update({'iconColor': 'rgb(255, 0, 16)', 'weight': '3'})
+    features.append({'type': 'Feature', 'geometry': {'type': 'Invalid'}})
+    collection = {'type': 'FeatureCollection', 'features': features}
+
+    with app.test_client() as client:
+        url = '/api/maps/{}/features/import'.format(uuid)
+        resp = client.post(url, data=json_dump(collection), headers=headers)
+        assert(resp.status_code == 201)
+        assert(resp.json['imported'] == 10)
+        assert(resp.json['skipped'] == 1)
+        assert(resp.json['version'] != version)
+
+        resp = client.post(url, data='{"features": [', headers=headers)
+        assert(resp.status_code == 400)
+
+        resp = client.get('/api/maps/{}/features'.format(uuid), headers=headers)
+        labels = [f['properties']['label'] for f in resp.json['features']]
+        assert(labels == [str(i) for i in range(10)])
+        assert(resp.json['features'][0]['properties']['iconColor'] == '#ff0010')
+        assert(resp.json['features'][0]['properties']['weight'] == 3)
+
+    m = Map.get(uuid)
+    assert(m.version == m.compute_version())
+
+
 def test_live(app, db):
     with app.test_client() as client:
         m = Map('foo', bbox=[1, 1, 1, 1])
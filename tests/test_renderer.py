@@ -1,9 +1,13 @@
+import os
+import sqlite3
+
 from imghdr import what as img_what
 from PyPDF2 import PdfFileReader
 from io import BytesIO
 from xml.etree import cElementTree as et
 from tests.fixtures import *
 from tests.utils import db_reset
+from app import background, tiles
 
 
 def setup_function(function):
@@ -90,6 +94,184 @@ def test_pdf(client, uuid, worker):
     assert resp.status_code == 200
 
 
+def test_degraded(app, client, uuid, worker, monkeypatch):
+    # tileserver unavailable
+    monkeypatch.setattr(background, 'get', lambda *args: None)
+
+    url = '/api/maps/{}/render/png:small'.format(uuid)
+    resp = client.json_get(url)
+    assert(resp.status_code == 202)
+    version = resp.json['version']
+    worker.work(burst=True)
+
+    # rendered (features only) and reported as such
+    status_url = '/api/maps/{}.png:small/{}/status'.format(uuid, version)
+    resp = client.json_get(status_url)
+    assert(resp.status_code == 200)
+    assert(resp.json['status'] == 'finished')
+    assert(resp.json['degraded'])
+
+    resp = client.get('/maps/{}.png:small/{}'.format(uuid, version))
+    assert(resp.status_code == 200)
+    assert(img_what(None, resp.data) == 'png')
+    assert('immutable' not in resp.headers.get('Cache-Control', ''))
+
+    # rendered again (with background) on the next render request
+    monkeypatch.undo()
+    resp = client.json_get(url)
+    assert(resp.status_code == 202)
+    assert(client.json_get(url).json['job_id'] == resp.json['job_id'])
+    worker.work(burst=True)
+
+    resp = client.json_get(status_url)
+    assert(resp.status_code == 200)
+    assert(not resp.json['degraded'])
+
+
+def test_background_errors(app, uuid, monkeypatch):
+    from app.models import Map
+    from app.surface import SurfaceRenderer
+
+    data = Map.get(uuid).to_dict(grid_included=True, features_included=True)
+    for error in [OSError('disk full'), sqlite3.OperationalError('locked')]:
+        def get(*args):
+            raise error
+
+        # rendered without background instead of failing
+        monkeypatch.setattr(background, 'get', get)
+        renderer = SurfaceRenderer(data)
+        renderer.render()
+        assert(renderer.degraded)
+
+
+def test_background_overlap(app, uuid, monkeypatch):
+    import time
+    from app.models import Map
+    from app.surface import SurfaceRenderer
+
+    def get(*args):
+        time.sleep(0.5)
+        return None
+
+    monkeypatch.setattr(background, 'get', get)
+    data = Map.get(uuid).to_dict(grid_included=True, features_included=True)
+    renderer = SurfaceRenderer(data)
+
+    # the fetch started with the renderer, work done meanwhile (like mapnik
+    # rendering) shortens the wait for it
+    time.sleep(0.3)
+    renderer.render()
+    timings = renderer.timings
+    assert(timings['background'] >= 0.5)
+    assert(timings['background_wait'] < timings['background'] - 0.2)
+    assert(set(timings) == {'setup', 'mapnik', 'background', 'background_wait', 'merge'})
+
+
+def test_render_worker(app, client, uuid):
+    url = '/api/maps/{}/render/png:small'.format(uuid)
+    resp = client.json_get(url)
+    assert(resp.status_code == 202)
+    version = resp.json['version']
+
+    result = app.test_cli_runner().invoke(args=['render-worker', '--burst'])
+    assert(result.exit_code == 0)
+
+    url = '/api/maps/{}.png:small/{}/status'.format(uuid, version)
+    resp = client.json_get(url)
+    assert(resp.status_code == 200)
+    assert(resp.json['status'] == 'finished')
+
+
+def test_background_cache(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'BACKGROUND_CACHE_DIR', str(tmp_path))
+    bbox = [13.421731, 52.455879, 13.494473, 52.477631]
+    url = background.url_for_background('bright', bbox, 10, 10)
+    with open(background.cached_filename(url), 'wb') as f:
+        f.write(b'cached')
+
+    # served from disk (the tileserver is not asked at all)
+    monkeypatch.setattr(background, 'fetch', None)
+    assert(background.get('bright', bbox, 10, 10) == b'cached')
+
+
+def test_background_not_png(app, tmp_path, monkeypatch):
+    class Response:
+        status_code = 200
+        content = b'<html>proxy error</html>'
+
+    monkeypatch.setitem(app.config, 'BACKGROUND_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(background.session(), 'get', lambda url, **kwargs: Response())
+    bbox = [13.421731, 52.455879, 13.494473, 52.477631]
+    assert(background.get('bright', bbox, 10, 10) is None)
+    assert(not list(tmp_path.iterdir()))
+
+
+def test_background_circuit_breaker(app, monkeypatch):
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        raise background.requests.ConnectionError()
+
+    monkeypatch.setattr(background.session(), 'get', get)
+    monkeypatch.setitem(app.config, 'BREAKER_THRESHOLD', 2)
+    connection = app.task_queue.connection
+    connection.delete(background.BREAKER_OPEN_KEY, background.BREAKER_FAILURES_KEY)
+    try:
+        assert(background.fetch('http://tileserver/a.png') is None)
+        assert(background.is_available())
+        assert(background.fetch('http://tileserver/a.png') is None)
+        assert(not background.is_available())
+
+        # fails fast while open
+        assert(background.fetch('http://tileserver/a.png') is None)
+        assert(len(calls) == 2)
+    finally:
+        connection.delete(background.BREAKER_OPEN_KEY, background.BREAKER_FAILURES_KEY)
+
+
+def test_tiles_compose(app, tmp_path, monkeypatch):
+    import cairo
+    monkeypatch.setitem(app.config, 'TILES_CACHE_DIR', str(tmp_path))
+
+    tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, tiles.TILE_SIZE, tiles.TILE_SIZE)
+    ctx = cairo.Context(tile)
+    ctx.set_source_rgb(1, 0, 0)
+    ctx.paint()
+    f = BytesIO()
+    tile.write_to_png(f)
+
+    bbox = [13.421731, 52.455879, 13.494473, 52.477631]
+    z = tiles.zoom_for_bbox(bbox, 400)
+    min_x, max_y = tiles.to_pixels(bbox[0], bbox[1], z)
+    max_x, min_y = tiles.to_pixels(bbox[2], bbox[3], z)
+    assert(max_x - min_x >= 400)
+
+    cache = tiles.TileCache(tiles.cache_filename('bright'), 'bright')
+    for x in range(int(min_x // 256), int(max_x // 256) + 1):
+        for y in range(int(min_y // 256), int(max_y // 256) + 1):
+            cache.set(z, x, y, f.getvalue())
+    cache.close()
+
+    # composed of cached tiles only
+    monkeypatch.setattr(background, 'fetch', None)
+    data = tiles.compose('bright', bbox, 400, 300)
+    surface = cairo.ImageSurface.create_from_png(BytesIO(data))
+    assert((surface.get_width(), surface.get_height()) == (400, 300))
+
+
+def test_background_cache_trim(tmp_path):
+    for i, name in enumerate(['old', 'unused', 'new']):
+        filename = tmp_path / (name + '.png')
+        filename.write_bytes(b'x' * 10)
+        os.utime(filename, (i, i))
+    # the old one was used most recently
+    os.utime(tmp_path / 'old.png', (3, 3))
+
+    background.trim(str(tmp_path), 20)
+    assert(sorted(p.name for p in tmp_path.iterdir()) == ['new.png', 'old.png'])
+
+
 #def test_svg(client, uuid, worker):
 #    url = '/api/maps/{}/render/svg'.format(uuid)
 #    resp = client.json_get(url)
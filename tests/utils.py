@@ -1,6 +1,23 @@
+from contextlib import contextmanager
 from shutil import rmtree
+from sqlalchemy import event
 from app.models import Map, Feature, db
 
 def db_reset():
     db.session.execute(Feature.__table__.delete())
     db.session.execute(Map.__table__.delete())
+
+
+@contextmanager
+def count_queries():
+    """Collects all SQL statements issued while the context is active"""
+    statements = []
+
+    def receive(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', receive)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', receive)